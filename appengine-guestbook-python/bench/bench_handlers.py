@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""Handler benchmarks against the local App Engine service stubs.
+
+Seeds the datastore stub with a synthetic catalog, carts and sales, then
+drives the WSGI app in-process and reports, per scenario, the latency,
+the number of datastore RPCs and the peak memory growth. Nothing talks to
+a deployed service.
+
+    python bench/bench_handlers.py --sdk $SDK --wines 10000 --sales 50000 \
+        --output results.json --baseline previous.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COUNTRIES = [u'France', u'Italy', u'Spain', u'US', u'Argentina', u'Chile']
+REGIONS = [u'Bordeaux', u'Bourgogne', u'Toscana', u'Rioja', u'Napa Valley',
+           u'Mendoza', u'Maipo']
+VARIETIES = [u'Pinot Noir', u'Chardonnay', u'Malbec', u'Riesling',
+             u'Sauvignon Blanc', u'Zinfandel', u'Red Blend']
+TYPES = [u'Red', u'White', u'Rose', u'Sparkling']
+USER = 'bench@example.com'
+
+
+def setup_sdk(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+
+def setup_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(user_email=USER, user_id='1', user_is_admin='1',
+                  overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    return bed
+
+
+class RPCCounter(object):
+    """Counts datastore RPCs, by call, while enabled."""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        self.calls = {}
+        self.enabled = False
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'bench_rpc_counter', self.hook, 'datastore_v3')
+
+    def hook(self, service, call, request, response, rpc=None, error=None):
+        if self.enabled:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+
+def seed(guestbook, args, rng):
+    rows = []
+    for i in range(args.wines):
+        rows.append((i, {
+            'type': rng.choice(TYPES),
+            'country': rng.choice(COUNTRIES),
+            'region': rng.choice(REGIONS),
+            'variety': rng.choice(VARIETIES),
+            'winery': u'Winery %d' % rng.randint(0, max(1, args.wines // 20)),
+            'year': str(rng.randint(1990, 2017)),
+            'price': str(rng.randint(5, 200)),
+        }))
+    for start in range(0, len(rows), 10000):
+        guestbook.import_wines(rows[start:start + 10000])
+    wine_ids = [k.id() for k in guestbook.Wine.query().fetch(keys_only=True)]
+
+    fill_cart(guestbook, wine_ids, args.cart_entries, rng)
+
+    sales = []
+    now = int(time.time())
+    for i in range(args.sales):
+        owner = 'user%d@example.com' % rng.randint(0, 999)
+        items = [guestbook.SaleItem(wine_id=w, quantity=rng.randint(1, 3),
+                                    unit_price_cents=rng.randint(500, 20000))
+                 for w in rng.sample(wine_ids, min(len(wine_ids), 3))]
+        sales.append(guestbook.Sales(
+            parent=guestbook.sales_shard_key(owner), owner=owner,
+            items=items, timestamp=now - rng.randint(0, 365 * 86400),
+            price=sum(i.quantity * i.unit_price_cents for i in items)))
+        if len(sales) == 1000:
+            seed_sales(guestbook, sales)
+            sales = []
+    seed_sales(guestbook, sales)
+    return wine_ids
+
+
+def seed_sales(guestbook, sales):
+    """Writes sales and adds them straight to the rollups (shard 0)."""
+    from google.appengine.ext import ndb
+
+    if not sales:
+        return
+    ndb.put_multi(sales)
+    totals = {}
+    for sale in sales:
+        day = guestbook.sale_day(sale.timestamp)
+        for key, (bottles, cents) in guestbook.sale_rollup_deltas(sale).items():
+            days = [day]
+            if key[0] != 'day':
+                days += [day[:7], guestbook.ALL_DAYS]
+            for rollup_day in days:
+                total = totals.setdefault(key + (rollup_day,), [0, 0])
+                total[0] += bottles
+                total[1] += cents
+
+    keys = [guestbook.rollup_key(dimension, value, day, 0)
+            for dimension, value, day in totals]
+    counters = []
+    for key, item, counter in zip(keys, totals.items(), ndb.get_multi(keys)):
+        (dimension, value, day), (bottles, cents) = item
+        if counter is None:
+            counter = guestbook.SalesRollup(key=key, dimension=dimension,
+                                            value=value, day=day)
+        counter.bottles += bottles
+        counter.cents += cents
+        counters.append(counter)
+    ndb.put_multi(counters)
+
+
+def fill_cart(guestbook, wine_ids, count, rng):
+    from google.appengine.ext import ndb
+
+    from google.appengine.api import users
+
+    # The nickname the handlers see for the testbed's signed-in user.
+    nickname = users.User(USER).nickname()
+    entries = [guestbook.CartEntry(parent=guestbook.cart_key(nickname),
+                                   wine_id=rng.choice(wine_ids),
+                                   owner=nickname)
+               for _ in range(count)]
+    ndb.put_multi(entries)
+    guestbook.build_cart_summary(nickname).put()
+
+
+def current_rss_kb():
+    """The process's resident set size now (not its peak), or None where
+    /proc is not available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_scenario(name, request, counter, iterations, before=None):
+    latencies = []
+    rss_growth = []
+    counter.calls = {}
+    rss_start = current_rss_kb()
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        rss_before = current_rss_kb()
+        counter.enabled = True
+        start = time.time()
+        request()
+        latencies.append((time.time() - start) * 1000)
+        counter.enabled = False
+        if rss_before is not None:
+            rss_growth.append(current_rss_kb() - rss_before)
+    rss_end = current_rss_kb()
+
+    return {
+        "iterations": iterations,
+        "mean_ms": sum(latencies) / len(latencies),
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "rpcs_per_request": sum(counter.calls.values()) / float(iterations),
+        "rpcs_by_call": dict((call, n / float(iterations))
+                             for call, n in counter.calls.items()),
+        # Current RSS, so growth is not hidden by the peak seeding set.
+        "rss_growth_kb": (rss_end - rss_start
+                          if rss_start is not None else None),
+        "max_request_rss_growth_kb": max(rss_growth) if rss_growth else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the p50 change per scenario; returns the regressed ones."""
+    regressed = []
+    for name, result in sorted(results.items()):
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            continue
+        ratio = result['p50_ms'] / max(old['p50_ms'], 1e-6)
+        print('%-12s p50 %8.2f ms -> %8.2f ms (x%.2f), rpcs %.1f -> %.1f' % (
+            name, old['p50_ms'], result['p50_ms'], ratio,
+            old['rpcs_per_request'], result['rpcs_per_request']))
+        if ratio > 1 + tolerance or \
+                result['rpcs_per_request'] > old['rpcs_per_request']:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path to the App Engine Python SDK.')
+    parser.add_argument('--wines', type=int, default=1000)
+    parser.add_argument('--cart_entries', type=int, default=20)
+    parser.add_argument('--sales', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline',
+                        help='Earlier results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p50 slowdown against the baseline.')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required.')
+
+    setup_sdk(args.sdk)
+    bed = setup_testbed()
+    import webtest
+    # guestbook picks its template settings (DEBUG, auto_reload) from
+    # SERVER_SOFTWARE at import time: measure the production ones.
+    server_software = os.environ['SERVER_SOFTWARE']
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/bench'
+    import guestbook
+    os.environ['SERVER_SOFTWARE'] = server_software
+
+    rng = random.Random(args.seed)
+    counter = RPCCounter()
+    seed_start = time.time()
+    wine_ids = seed(guestbook, args, rng)
+    seed_seconds = time.time() - seed_start
+
+    test_app = webtest.TestApp(guestbook.app)
+    new_wine = {'wine_type': 'Red', 'wine_country': 'France',
+                'wine_region': 'Bordeaux', 'wine_variety': 'Merlot',
+                'wine_winery': 'Bench', 'wine_year': '2015',
+                'wine_price': '20'}
+
+    scenarios = [
+        ('display', lambda: test_app.get(
+            '/display?wine_type=red&wine_country=fra'), None),
+        ('api_cart', lambda: test_app.get('/api/cart'), None),
+        ('api_sales', lambda: test_app.get('/api/sales'), None),
+        ('checkout', lambda: test_app.delete('/api/cart?checkout=True'),
+         lambda: fill_cart(guestbook, wine_ids, args.cart_entries, rng)),
+        ('add', lambda: test_app.post('/add', new_wine), None),
+    ]
+    results = {}
+    for name, request, before in scenarios:
+        results[name] = run_scenario(name, request, counter,
+                                     args.iterations, before)
+
+    report = {
+        "config": {"wines": args.wines, "cart_entries": args.cart_entries,
+                   "sales": args.sales, "iterations": args.iterations,
+                   "seed": args.seed, "seed_seconds": seed_seconds},
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    bed.deactivate()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print('Regressed: %s' % ', '.join(regressed))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
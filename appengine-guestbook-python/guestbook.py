@@ -18,15 +18,38 @@
 import os
 import urllib
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import users
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 
 import jinja2
 import webapp2
 import json
 import unicodedata
 import time
-import copy
+import base64
+import calendar
+import datetime
+import hashlib
+import heapq
+import itertools
+import zlib
+import threading
+import collections
+import re
+import email.utils
+import csv
+import bisect
+import cProfile
+import logging
+import pstats
+import StringIO
+import uuid
 
 def get_user(request):
     user = users.get_current_user()
@@ -53,10 +76,304 @@ def remove_accent(input_str):
         return u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
 
+# Search index.
+#
+# Every Wine carries a repeated, indexed 'search_tokens' property holding
+# the 1..SEARCH_NGRAM-grams of its normalized fields, prefixed by the field
+# name (u'country:fra'). A search is a conjunction of equality filters on
+# that property, so the datastore intersects the posting lists (merge join)
+# and we only ever read the candidates we are going to show.
+SEARCH_NGRAM = 3
+SEARCH_FIELDS = [
+    ('type', 'wine_type'),
+    ('country', 'wine_country'),
+    ('region', 'wine_region'),
+    ('variety', 'wine_variety'),
+    ('winery', 'wine_winery'),
+    ('year', 'wine_year'),
+]
+DISPLAY_PAGE_SIZE = 10
+# Most wines one search reads (and post-filters), and the batch size of
+# range queries, whose results are mostly post-filtered.
+SEARCH_SCAN_BUDGET = 500
+SEARCH_BATCH_SIZE = 100
+
+# Numeric fields /display can filter on (min_<field>, max_<field>) and sort
+# on (sort=<field> or sort=-<field>): field -> (Wine property, scale).
+RANGE_FIELDS = {
+    'price': ('wine_price_cents', 100),
+    'year': ('wine_year_num', 1),
+}
+DISPLAY_PARAMS = ['min_price', 'max_price', 'min_year', 'max_year', 'sort']
+
+# Paginated endpoints take 'page_size' and an opaque 'cursor' token, and
+# hand back the token for the following page.
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def normalize_field(value):
+    if value is None:
+        return u''
+    return remove_accent(value).strip().lower()
+
+
+def field_ngrams(value):
+    grams = set()
+    for n in range(1, SEARCH_NGRAM + 1):
+        for i in range(len(value) - n + 1):
+            grams.add(value[i:i + n])
+    return grams
+
+
+def query_ngrams(value):
+    """Returns the n-grams a field must contain to match `value`.
+
+    Short values are indexed as-is; longer ones are covered by
+    non-overlapping grams plus the trailing one, which keeps the number of
+    filters low. Matches are confirmed by `wine_matches`.
+    """
+    if len(value) <= SEARCH_NGRAM:
+        return [value]
+    last = len(value) - SEARCH_NGRAM
+    starts = list(range(0, last, SEARCH_NGRAM)) + [last]
+    return sorted(set(value[i:i + SEARCH_NGRAM] for i in starts))
+
+
+def search_criteria(request):
+    criteria = {}
+    for field, prop in SEARCH_FIELDS:
+        value = normalize_field(request.get(prop))
+        if value == u'':
+            continue
+        if field == 'type' and value == u'all':
+            continue
+        if field == 'year' and (not value.isdigit() or int(value) <= 0):
+            continue
+        criteria[field] = value
+    return criteria
+
+
+def parse_number(value, scale=1):
+    """Returns round(value * scale), or None unless it is a finite number
+    that fits an IntegerProperty."""
+    try:
+        number = int(round(float(value) * scale))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not -2 ** 63 <= number < 2 ** 63:
+        return None
+    return number
+
+
+def range_criteria(request):
+    """Returns {property name: (low, high)} for min_/max_ price and year.
+
+    Bounds are inclusive and either may be None; prices are in dollars.
+    """
+    ranges = {}
+    for field, (prop, scale) in sorted(RANGE_FIELDS.items()):
+        low = parse_number(request.get('min_' + field), scale)
+        high = parse_number(request.get('max_' + field), scale)
+        if low is not None or high is not None:
+            ranges[prop] = (low, high)
+    return ranges
+
+
+def sort_request(request):
+    """Returns the ('-')property name to sort on, or None."""
+    sort = request.get('sort')
+    if sort.lstrip('-') not in RANGE_FIELDS:
+        return None
+    prop = RANGE_FIELDS[sort.lstrip('-')][0]
+    return '-' + prop if sort.startswith('-') else prop
+
+
+def page_size_request(request, default=DEFAULT_PAGE_SIZE):
+    try:
+        page_size = int(request.get('page_size', default))
+    except ValueError:
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def page_request(request, default=DEFAULT_PAGE_SIZE):
+    """Returns the (page_size, start_cursor) asked for by `request`."""
+    page_size = page_size_request(request, default)
+
+    cursor = None
+    if request.get('cursor') != '':
+        try:
+            cursor = Cursor(urlsafe=request.get('cursor'))
+        except datastore_errors.BadValueError:
+            webapp2.abort(400, 'Invalid cursor.')
+    return page_size, cursor
+
+
+def cursor_token(cursor, more=True):
+    if cursor is None or not more:
+        return None
+    return cursor.urlsafe()
+
+
+def wine_matches(wine, criteria, ranges=None):
+    for field, prop in SEARCH_FIELDS:
+        if field in criteria and \
+                criteria[field] not in normalize_field(getattr(wine, prop)):
+            return False
+    for prop, (low, high) in (ranges or {}).items():
+        value = getattr(wine, prop)
+        if value is None or (low is not None and value < low) or \
+                (high is not None and value > high):
+            return False
+    return True
+
+
+DEBUG = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+# Compiled templates are shared between instances through memcache, and
+# template files are only stat()ed for changes on the dev server.
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
     extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+    autoescape=True,
+    auto_reload=DEBUG,
+    bytecode_cache=jinja2.MemcachedBytecodeCache(memcache,
+                                                 prefix='jinja2/bytecode/'))
+TEMPLATE_NAMES = ['index.html', 'new_entry.html', 'display.html',
+                  'search.html', 'cart.html', 'sales.html']
+
+
+# Request metrics.
+#
+# MetricsMiddleware times every request and aggregates, per route, a
+# latency histogram together with the datastore RPCs, bytes and entities
+# counted by an apiproxy hook and the time spent rendering templates.
+# Admins can read them at /api/metrics, and profile a single request by
+# sending an 'X-Profile: 1' header.
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+_request_stats = threading.local()
+
+
+class RequestStats(object):
+    """What a single request spent, filled in as it runs."""
+    def __init__(self):
+        self.rpcs = collections.Counter()
+        self.rpc_bytes = 0
+        self.entities = 0
+        self.template_ms = 0.0
+
+
+def current_request_stats():
+    return getattr(_request_stats, 'stats', None)
+
+
+def _count_datastore_rpc(service, call, request, response, rpc=None,
+                         error=None):
+    stats = current_request_stats()
+    if stats is None:
+        return
+    stats.rpcs[call] += 1
+    try:
+        stats.rpc_bytes += request.ByteSize() + response.ByteSize()
+        if call == 'Get':
+            stats.entities += response.entity_size()
+        elif call in ('RunQuery', 'Next'):
+            stats.entities += response.result_size()
+    except AttributeError:
+        pass
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'request_metrics', _count_datastore_rpc, 'datastore_v3')
+
+
+def render_template(name, values):
+    start = time.time()
+    body = JINJA_ENVIRONMENT.get_template(name).render(values)
+    stats = current_request_stats()
+    if stats is not None:
+        stats.template_ms += (time.time() - start) * 1000
+    return body
+
+
+class RouteMetrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.latency_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.rpcs = collections.Counter()
+        self.rpc_bytes = 0
+        self.entities = 0
+        self.template_ms = 0.0
+
+    def add(self, latency_ms, stats):
+        self.requests += 1
+        self.latency_ms += latency_ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        self.rpcs.update(stats.rpcs)
+        self.rpc_bytes += stats.rpc_bytes
+        self.entities += stats.entities
+        self.template_ms += stats.template_ms
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "latency_ms": {
+                "mean": self.latency_ms / max(1, self.requests),
+                "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS_MS] +
+                                    ["inf"], self.buckets)),
+            },
+            "datastore_rpcs": dict(self.rpcs),
+            "datastore_bytes": self.rpc_bytes,
+            "entities_fetched": self.entities,
+            "template_ms": self.template_ms,
+        }
+
+
+class MetricsMiddleware(object):
+    """Records RouteMetrics for each request to the wrapped app."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = set(routes)
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def __call__(self, environ, start_response):
+        route = environ.get('PATH_INFO')
+        if route not in self.routes:
+            route = '<other>'
+
+        stats = RequestStats()
+        _request_stats.stats = stats
+        start = time.time()
+        try:
+            if environ.get('HTTP_X_PROFILE') and users.is_current_user_admin():
+                return self.profile(environ, start_response)
+            return self.app(environ, start_response)
+        finally:
+            latency_ms = (time.time() - start) * 1000
+            _request_stats.stats = None
+            with self.lock:
+                self.metrics.setdefault(route, RouteMetrics()).add(
+                    latency_ms, stats)
+
+    def profile(self, environ, start_response):
+        profiler = cProfile.Profile()
+        result = profiler.runcall(self.app, environ, start_response)
+        out = StringIO.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(
+            'cumulative').print_stats(50)
+        logging.info('Profile of %s:\n%s', environ.get('PATH_INFO'),
+                     out.getvalue())
+        return result
+
+    def snapshot(self):
+        with self.lock:
+            return dict((route, m.to_dict())
+                        for route, m in self.metrics.items())
 # [END imports]
 
 DEFAULT_GUESTBOOK_NAME = 'default_guestbook'
@@ -75,15 +392,125 @@ def guestbook_key(guestbook_name=DEFAULT_GUESTBOOK_NAME):
     """
     return ndb.Key('Guestbook', guestbook_name)
 
+# Wines, carts and sales used to live under one hard-coded parent each,
+# which capped every kind at ~1 write/second. New entities are spread
+# over several entity groups instead:
+#   - each user's cart entries live under their own Cart/<nickname> group;
+#   - sales are hashed on their buyer into NUM_SALES_SHARDS groups;
+#   - wines are spread over NUM_WINE_SHARDS groups by id, so a wine id
+#     alone is enough to rebuild its key.
+# The old single parents are still read from so that existing wines and
+# sales stay visible.
+NUM_WINE_SHARDS = 10
+NUM_SALES_SHARDS = 20
+
+
 def wine_key():
+    """Legacy parent of the wines created before sharding."""
     return ndb.Key('Wines', 'wine_storage')
 
-def cart_key():
+def wine_shard_key(shard):
+    return ndb.Key('Wines', 'wine_storage_%d' % shard)
+
+def new_wine_keys(count):
+    first, last = Wine.allocate_ids(count)
+    return [sharded_wine_key(wine_id) for wine_id in range(first, last + 1)]
+
+def sharded_wine_key(wine_id):
+    return ndb.Key(Wine, wine_id,
+                   parent=wine_shard_key(wine_id % NUM_WINE_SHARDS))
+
+def new_wine_key():
+    return new_wine_keys(1)[0]
+
+def cart_key(nickname):
+    return ndb.Key('Cart', nickname)
+
+
+def legacy_cart_key():
+    """The parent every cart entry shared before carts were split; see
+    MigrateCarts."""
     return ndb.Key('Cart', 'cart_storage')
 
 def sales_key():
+    """Legacy parent of the sales recorded before sharding."""
     return ndb.Key('Sales', 'sales_storage')
 
+def sales_shard_key(owner):
+    shard = zlib.crc32(owner.encode('utf-8')) % NUM_SALES_SHARDS
+    return ndb.Key('Sales', 'sales_storage_%d' % shard)
+
+def sales_shard_keys():
+    return [sales_key()] + [ndb.Key('Sales', 'sales_storage_%d' % shard)
+                            for shard in range(NUM_SALES_SHARDS)]
+
+
+def _decode_shard_token(token, num_shards):
+    if token == '':
+        return [[None, 0]] * num_shards
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        positions = None
+    if not isinstance(positions, list) or len(positions) != num_shards:
+        webapp2.abort(400, 'Invalid cursor.')
+    return positions
+
+
+def fetch_page_sharded(make_query, parents, page_size, sort_key, token=''):
+    """Fetches one page of a query fanned out over several entity groups.
+
+    `make_query(parent)` builds the per-shard ancestor query, whose order
+    must agree with `sort_key`. Every shard is queried concurrently and the
+    results are merged. Returns (results, next_token); the opaque token
+    records, per shard, the cursor and offset the next page resumes from.
+    """
+    positions = _decode_shard_token(token, len(parents))
+    futures = []
+    for parent, position in zip(parents, positions):
+        if position is None:
+            futures.append(None)
+            continue
+        cursor = None
+        try:
+            if position[0] is not None:
+                cursor = Cursor(urlsafe=position[0])
+            offset = int(position[1])
+        except (datastore_errors.BadValueError, TypeError, ValueError,
+                IndexError):
+            webapp2.abort(400, 'Invalid cursor.')
+        futures.append(make_query(parent).fetch_page_async(
+            page_size, start_cursor=cursor, offset=offset))
+
+    pages = [f.get_result() if f is not None else None for f in futures]
+    runs = []
+    for i, page in enumerate(pages):
+        if page is not None:
+            runs.append([(sort_key(e), i, j) for j, e in enumerate(page[0])])
+
+    results = []
+    consumed = [0] * len(parents)
+    for _, i, j in itertools.islice(heapq.merge(*runs), page_size):
+        results.append(pages[i][0][j])
+        consumed[i] += 1
+
+    next_positions = []
+    for position, page, taken in zip(positions, pages, consumed):
+        if page is None:
+            next_positions.append(None)
+            continue
+        entities, next_cursor, more = page
+        if taken < len(entities):
+            next_positions.append([position[0], int(position[1]) + taken])
+        elif more and next_cursor is not None:
+            next_positions.append([next_cursor.urlsafe(), 0])
+        else:
+            next_positions.append(None)
+
+    if all(p is None for p in next_positions):
+        return results, None
+    return results, base64.urlsafe_b64encode(json.dumps(next_positions))
+
 # [START greeting]
 class Author(ndb.Model):
     """Sub model for representing an author."""
@@ -99,6 +526,398 @@ class Wine(ndb.Model):
     wine_winery = ndb.StringProperty(indexed=False)
     wine_year = ndb.StringProperty(indexed=False)
     wine_price = ndb.StringProperty(indexed=False)
+    search_tokens = ndb.StringProperty(repeated=True)
+
+    # Typed and normalized copies of the fields above, for datastore-side
+    # filtering and sorting. /admin/reindex fills them for older wines.
+    wine_type_norm = ndb.ComputedProperty(
+        lambda self: normalize_field(self.wine_type))
+    wine_country_norm = ndb.ComputedProperty(
+        lambda self: normalize_field(self.wine_country))
+    wine_region_norm = ndb.ComputedProperty(
+        lambda self: normalize_field(self.wine_region))
+    wine_variety_norm = ndb.ComputedProperty(
+        lambda self: normalize_field(self.wine_variety))
+    wine_winery_norm = ndb.ComputedProperty(
+        lambda self: normalize_field(self.wine_winery))
+    wine_year_num = ndb.ComputedProperty(
+        lambda self: parse_number(self.wine_year))
+    wine_price_cents = ndb.ComputedProperty(
+        lambda self: parse_number(self.wine_price, 100))
+
+    def _pre_put_hook(self):
+        tokens = set()
+        for field, prop in SEARCH_FIELDS:
+            for gram in field_ngrams(normalize_field(getattr(self, prop))):
+                tokens.add(u'%s:%s' % (field, gram))
+        self.search_tokens = sorted(tokens)
+
+    @classmethod
+    def token_query(cls, criteria):
+        query = cls.query()
+        for field in sorted(criteria):
+            for gram in query_ngrams(criteria[field]):
+                query = query.filter(
+                    cls.search_tokens == u'%s:%s' % (field, gram))
+        return query
+
+    @classmethod
+    def range_query(cls, criteria, ranges, sort):
+        """Builds a query on the typed properties.
+
+        Type and country match as substrings, as in `token_query`: they
+        become equality filters only when exactly one known value (see
+        AutocompleteIndex) contains them. The datastore accepts one
+        inequality, so only the range on the sort property (or the first
+        range given) is applied by the query; the rest is left to
+        `wine_matches`. Needs the composite indexes in index.yaml.
+        """
+        query = cls.query()
+        for field, prop in (('type', cls.wine_type_norm),
+                            ('country', cls.wine_country_norm)):
+            if field in criteria:
+                values = AUTOCOMPLETE_INDEX.containing(field, criteria[field])
+                if len(values) == 1:
+                    query = query.filter(prop == values[0])
+
+        prop_name = sort.lstrip('-') if sort else sorted(ranges)[0]
+        prop = getattr(cls, prop_name)
+        low, high = ranges.get(prop_name, (None, None))
+        if low is not None:
+            query = query.filter(prop >= low)
+        if high is not None:
+            query = query.filter(prop <= high)
+        return query.order(-prop if sort and sort.startswith('-') else prop)
+
+    @classmethod
+    def search(cls, criteria, limit, start_cursor=None, ranges=None,
+               sort=None):
+        """Returns up to `limit` matching wines and the next-page cursor.
+
+        Text criteria go through the token index, with ranges checked by
+        `wine_matches`; only a sort needs the range query. Either way at
+        most SEARCH_SCAN_BUDGET wines are read per call: a selective
+        search can return a short (even empty) page with a cursor to
+        carry on from.
+        """
+        # Searches span every wine shard, so they are eventually consistent.
+        if sort or (ranges and not criteria):
+            query = cls.range_query(criteria, ranges or {}, sort)
+            batch_size = max(limit, SEARCH_BATCH_SIZE)
+        else:
+            query = cls.token_query(criteria)
+            batch_size = limit
+
+        wines = []
+        scanned = 0
+        exhausted = True
+        it = query.iter(batch_size=batch_size, start_cursor=start_cursor,
+                        produce_cursors=True)
+        for w in it:
+            scanned += 1
+            if wine_matches(w, criteria, ranges):
+                wines.append(w)
+            if len(wines) == limit or scanned == SEARCH_SCAN_BUDGET:
+                exhausted = False
+                break
+        if exhausted or not it.probably_has_next():
+            return wines, None
+        return wines, it.cursor_after()
+
+    def to_dict(self):
+        return {"wine_id": self.key.id(), "type": self.wine_type,
+                "country": self.wine_country, "region": self.wine_region,
+                "variety": self.wine_variety, "winery": self.wine_winery,
+                "year": self.wine_year, "price": self.wine_price}
+
+
+def wine_keys_for_id(wine_id):
+    """Returns the keys a wine with this id may have: sharded, then legacy."""
+    return [sharded_wine_key(wine_id),
+            ndb.Key(Wine, wine_id, parent=wine_key())]
+
+
+@ndb.tasklet
+def fetch_wine_dicts_async(wine_ids):
+    """Batch-fetches the given wines from the datastore, as id -> dict."""
+    keys = []
+    for wine_id in set(wine_ids):
+        keys.extend(wine_keys_for_id(wine_id))
+    wines = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((w.key.id(), w.to_dict())
+                          for w in wines if w is not None))
+
+
+class VersionStamp(object):
+    """A counter in memcache, bumped on every write to some set of data.
+
+    Also records when it was last bumped. Readers compare versions for
+    equality to tell whether what they derived from the data is still
+    current.
+    """
+    def __init__(self, name):
+        self.version_key = name + '_version'
+        self.modified_key = name + '_modified'
+
+    @staticmethod
+    def new_seed():
+        # Random 62 bits, leaving incr() room to count: a counter that is
+        # reseeded after an eviction lands on a value some reader already
+        # holds only by chance (bumps / 2**62).
+        return uuid.uuid4().int >> 66
+
+    @classmethod
+    @ndb.tasklet
+    def read_all_async(cls, stamps):
+        """Returns [(version, modified time)] for `stamps`.
+
+        The memcache reads go through the ndb context, which batches them
+        with whatever else the request has in flight.
+        """
+        ctx = ndb.get_context()
+        keys = []
+        for stamp in stamps:
+            keys.extend([stamp.version_key, stamp.modified_key])
+        values = yield [ctx.memcache_get(key) for key in keys]
+
+        # Evicted stamps are seeded, then read back: another request may
+        # have won the add.
+        evicted = [i for i in range(0, len(keys), 2) if values[i] is None]
+        if evicted:
+            yield [f for i in evicted for f in (
+                ctx.memcache_add(keys[i + 1], int(time.time())),
+                ctx.memcache_add(keys[i], cls.new_seed()))]
+            reread = yield [ctx.memcache_get(keys[i + j])
+                            for i in evicted for j in (0, 1)]
+            for n, i in enumerate(evicted):
+                values[i:i + 2] = reread[2 * n:2 * n + 2]
+
+        ret = [(values[i], values[i + 1]) for i in range(0, len(keys), 2)]
+        raise ndb.Return(ret)
+
+    @classmethod
+    def read_all(cls, stamps):
+        return cls.read_all_async(stamps).get_result()
+
+    def get(self):
+        return self.read_all([self])[0]
+
+    def bump(self):
+        memcache.set(self.modified_key, int(time.time()))
+        if memcache.incr(self.version_key) is None:
+            memcache.set(self.version_key, self.new_seed())
+
+
+CATALOG_VERSION = VersionStamp('catalog')
+SALES_VERSION = VersionStamp('sales')
+
+
+class CatalogCache(object):
+    """Two-tier cache of serialized wines: this process, then memcache.
+
+    Entries are stamped with CATALOG_VERSION. Writes to the catalog bump
+    that version, which drops every instance's local copy and orphans the
+    memcache entries of the previous version. The cached dicts are
+    shared: copy them before mutating.
+    """
+    MAX_LOCAL_ENTRIES = 50000
+    # Cached in both tiers for ids with no wine, so that unknown ids (stale
+    # cart entries, unknown recommendation partners) are not re-fetched.
+    ABSENT = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.wines = {}
+        self.stats = {'local_hits': 0, 'memcache_hits': 0, 'misses': 0,
+                      'invalidations': 0}
+
+    def prime(self, limit):
+        """Loads up to `limit` wines into this process's tier."""
+        self.current_version()
+        wines = Wine.query().fetch(limit)
+        with self.lock:
+            for w in wines:
+                self.wines[w.key.id()] = w.to_dict()
+
+    @ndb.tasklet
+    def current_version_async(self):
+        [(version, _)] = yield VersionStamp.read_all_async([CATALOG_VERSION])
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.wines = {}
+                self.stats['invalidations'] += 1
+        raise ndb.Return(version)
+
+    def current_version(self):
+        return self.current_version_async().get_result()
+
+    def invalidate(self):
+        CATALOG_VERSION.bump()
+        self.current_version()
+
+    def get_many(self, wine_ids):
+        """Returns an id -> dict map of the given wines that exist."""
+        return self.get_many_async(wine_ids).get_result()
+
+    @ndb.tasklet
+    def get_many_async(self, wine_ids):
+        version = yield self.current_version_async()
+        prefix = 'wine:%s:' % version
+        wines = self.wines
+
+        found = {}
+        missing = []
+        for wine_id in set(wine_ids):
+            if wine_id in wines:
+                found[wine_id] = wines[wine_id]
+            else:
+                missing.append(wine_id)
+        local_hits = len(found)
+
+        fetched = {}
+        memcache_hits = 0
+        loaded_count = 0
+        if missing:
+            ctx = ndb.get_context()
+            cached = yield [ctx.memcache_get(prefix + str(i)) for i in missing]
+            for wine_id, wine in zip(missing, cached):
+                if wine is not None:
+                    fetched[wine_id] = wine
+            memcache_hits = len(fetched)
+            missing = [i for i in missing if i not in fetched]
+            if missing:
+                loaded = yield fetch_wine_dicts_async(missing)
+                loaded_count = len(missing)
+                for wine_id in missing:
+                    fetched[wine_id] = loaded.get(wine_id, self.ABSENT)
+                yield [ctx.memcache_set(prefix + str(i), fetched[i])
+                       for i in missing]
+
+        with self.lock:
+            self.stats['local_hits'] += local_hits
+            self.stats['memcache_hits'] += memcache_hits
+            self.stats['misses'] += loaded_count
+            if self.version == version:
+                if len(self.wines) + len(fetched) > self.MAX_LOCAL_ENTRIES:
+                    self.wines = {}
+                self.wines.update(fetched)
+
+        found.update(fetched)
+        raise ndb.Return(dict((i, wine) for i, wine in found.items()
+                              if wine != self.ABSENT))
+
+
+CATALOG_CACHE = CatalogCache()
+
+
+def get_wine_dicts(wine_ids):
+    """Returns the given wines as an id -> dict map, through the cache."""
+    return CATALOG_CACHE.get_many(wine_ids)
+
+
+def get_wine_dicts_async(wine_ids):
+    return CATALOG_CACHE.get_many_async(wine_ids)
+
+
+# Autocomplete.
+#
+# Every distinct value of the free-text search fields is one small
+# FieldValue entity, written (only when missing) whenever wines are
+# written, and FIELD_VALUES_VERSION is bumped when one is added. Each
+# instance holds the values as sorted arrays of (normalized, display)
+# values and answers prefix lookups by bisection; the arrays are reloaded
+# only when FIELD_VALUES_VERSION moves, so suggestions never query the
+# Wine kind.
+AUTOCOMPLETE_FIELDS = ['type', 'country', 'region', 'variety', 'winery']
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+
+
+class FieldValue(ndb.Model):
+    """One distinct value of a Wine field; see field_value_key()."""
+    field = ndb.StringProperty()
+    value = ndb.StringProperty(indexed=False)
+
+
+FIELD_VALUES_VERSION = VersionStamp('field_values')
+
+
+def field_value_key(field, normalized):
+    # Hashed, so that long values stay within the key name limit.
+    digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    return ndb.Key(FieldValue, '%s:%s' % (field, digest))
+
+
+def record_field_values(wines):
+    """Stores the wines' field values that are not known yet.
+
+    One root entity per value, written with plain puts: there is no shared
+    entity group to contend on, and re-putting wines (see ReindexWines)
+    backfills the values idempotently.
+    """
+    props = dict(SEARCH_FIELDS)
+    values = {}
+    for field in AUTOCOMPLETE_FIELDS:
+        for wine in wines:
+            value = (getattr(wine, props[field]) or u'').strip()
+            if value:
+                key = field_value_key(field, normalize_field(value))
+                values.setdefault(key, FieldValue(key=key, field=field,
+                                                  value=value))
+    keys = list(values)
+    missing = [values[key] for key, entity in zip(keys, ndb.get_multi(keys))
+               if entity is None]
+    if missing:
+        ndb.put_multi(missing)
+        FIELD_VALUES_VERSION.bump()
+
+
+class AutocompleteIndex(object):
+    """Per-instance sorted arrays over FieldValue, by FIELD_VALUES_VERSION."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.fields = {}
+
+    def load(self, version):
+        pairs = dict((field, []) for field in AUTOCOMPLETE_FIELDS)
+        for entity in FieldValue.query().iter(batch_size=1000):
+            if entity.field in pairs:
+                pairs[entity.field].append((normalize_field(entity.value),
+                                            entity.value))
+        fields = {}
+        for field, field_pairs in pairs.items():
+            field_pairs.sort()
+            fields[field] = ([n for n, _ in field_pairs],
+                             [v for _, v in field_pairs])
+        with self.lock:
+            self.version = version
+            self.fields = fields
+
+    def current_fields(self):
+        version = FIELD_VALUES_VERSION.get()[0]
+        if version != self.version:
+            self.load(version)
+        return self.fields
+
+    def suggest(self, field, prefix, limit=DEFAULT_SUGGESTIONS):
+        """Returns up to `limit` values of `field` starting with `prefix`,
+        ignoring case and accents."""
+        normalized, values = self.current_fields()[field]
+        prefix = normalize_field(prefix)
+        start = bisect.bisect_left(normalized, prefix)
+        end = bisect.bisect_left(normalized, prefix + u'\uffff', lo=start)
+        return values[start:min(end, start + limit)]
+
+    def containing(self, field, value):
+        """Returns the normalized values of `field` that contain `value`."""
+        return [n for n in self.current_fields()[field][0] if value in n]
+
+
+AUTOCOMPLETE_INDEX = AutocompleteIndex()
 
 
 class CartEntry(ndb.Model):
@@ -109,16 +928,85 @@ class CartEntry(ndb.Model):
     def get_from_nickname(cls, ancestor, name):
         return cls.query(CartEntry.owner==name, ancestor=ancestor).fetch()
 
+    @classmethod
+    def page_of_wine_ids_async(cls, nickname, page_size, start_cursor=None):
+        """Fetches a page of (entry key, wine_id) pairs, from the index only."""
+        return cls.query(ancestor=cart_key(nickname)).fetch_page_async(
+            page_size, start_cursor=start_cursor, projection=[cls.wine_id])
+
     # @classmethod
     # def get_from_id(cls, ancestor, entry_id)
 
 
+class SaleItem(ndb.Model):
+    """One line of a sale, priced as it was at checkout."""
+    wine_id = ndb.IntegerProperty()
+    quantity = ndb.IntegerProperty()
+    unit_price_cents = ndb.IntegerProperty()
+
+    def unit_cents(self, wine):
+        """Unit price in cents; legacy lines fall back on the catalog."""
+        if self.unit_price_cents is not None:
+            return self.unit_price_cents
+        return price_cents(wine['price'])
+
+
+class CartSummary(ndb.Model):
+    """Running bottle count and total of one user's cart.
+
+    Lives in the cart's entity group and is updated in the same
+    transactions as the entries, with prices as of when they were added.
+    """
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    total_cents = ndb.IntegerProperty(default=0, indexed=False)
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total_cents / 100.0}
+
+
 class Sales(ndb.Model):
+    # Legacy comma-joined wine ids, one per bottle. New sales use 'items';
+    # /admin/migrate_sales converts the old ones.
     wines_id = ndb.StringProperty()
+    items = ndb.LocalStructuredProperty(SaleItem, repeated=True)
     owner = ndb.StringProperty()
     timestamp = ndb.IntegerProperty()
+    # Total of the sale, in cents.
     price = ndb.IntegerProperty()
 
+    def line_items(self):
+        """Returns the sale's SaleItems, decoding legacy sales on the fly.
+
+        Lines decoded from 'wines_id' carry no unit price.
+        """
+        if self.items or not self.wines_id:
+            return self.items
+        counts = collections.OrderedDict()
+        for wine_id in self.wines_id.split(','):
+            if wine_id != '':
+                counts[long(wine_id)] = counts.get(long(wine_id), 0) + 1
+        return [SaleItem(wine_id=wine_id, quantity=quantity)
+                for wine_id, quantity in counts.items()]
+
+
+class SalesRollup(ndb.Model):
+    """One shard of the bottles/revenue counter of a (dimension, value, day).
+
+    dimension is one of ROLLUP_DIMENSIONS: value is then a wine id, a
+    winery name or the day itself. day is a YYYY-MM-DD day; wine and winery
+    counters also exist per YYYY-MM month and for ALL_DAYS.
+    """
+    dimension = ndb.StringProperty()
+    value = ndb.StringProperty()
+    day = ndb.StringProperty()
+    bottles = ndb.IntegerProperty(default=0, indexed=False)
+    cents = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class RollupMarker(ndb.Model):
+    """Records that one batch of a sale's rollup deltas has been applied."""
+    pass
+
 
 class Greeting(ndb.Model):
     """A main model for representing an individual Guestbook entry."""
@@ -128,14 +1016,544 @@ class Greeting(ndb.Model):
 # [END greeting]
 
 
+@ndb.tasklet
+def cart_contents_async(nickname, page_size, start_cursor=None):
+    """Returns a page of `nickname`'s cart grouped by wine, and the next token.
+
+    Entries are read from the index with a projection on wine_id and
+    grouped in one pass; only the distinct wines they reference are then
+    looked up, so the cost follows the cart size, not the catalog size.
+    """
+    entries, next_cursor, more = yield CartEntry.page_of_wine_ids_async(
+        nickname, page_size, start_cursor)
+
+    lines = collections.OrderedDict()
+    for e in entries:
+        lines.setdefault(e.wine_id, []).append(e.key.id())
+
+    ws = yield get_wine_dicts_async(lines.keys())
+    ret = [{"wine": ws[wine_id], "cart_entry": entry_ids}
+           for wine_id, entry_ids in lines.items() if wine_id in ws]
+    raise ndb.Return((ret, cursor_token(next_cursor, more)))
+
+
+def cart_summary_key(nickname):
+    return ndb.Key(CartSummary, 'summary', parent=cart_key(nickname))
+
+
+@ndb.tasklet
+def build_cart_summary_async(nickname):
+    """Recomputes a cart's summary from its entries."""
+    entries = yield CartEntry.query(ancestor=cart_key(nickname)).fetch_async()
+    prices = current_prices(e.wine_id for e in entries) if entries else {}
+    raise ndb.Return(CartSummary(
+        key=cart_summary_key(nickname), count=len(entries),
+        total_cents=sum(prices.get(e.wine_id, 0) for e in entries)))
+
+
+def build_cart_summary(nickname):
+    return build_cart_summary_async(nickname).get_result()
+
+
+@ndb.tasklet
+def get_cart_summary_async(nickname):
+    """Returns the cart's summary, building it for carts that predate it.
+
+    Outside transactions a built summary is stored (unless one appeared
+    meanwhile), so each cart, empty ones included, is only built once.
+    """
+    summary = yield cart_summary_key(nickname).get_async()
+    if summary is None:
+        summary = yield build_cart_summary_async(nickname)
+        if not ndb.in_transaction():
+            summary = yield CartSummary.get_or_insert_async(
+                'summary', parent=cart_key(nickname), count=summary.count,
+                total_cents=summary.total_cents)
+    raise ndb.Return(summary)
+
+
+def get_cart_summary(nickname):
+    return get_cart_summary_async(nickname).get_result()
+
+
+def add_to_cart(nickname, wine_id):
+    """Adds a bottle to the cart and returns the updated CartSummary."""
+    price = current_prices([wine_id]).get(wine_id, 0)
+    return _add_cart_entry(nickname, wine_id, price)
+
+
+@ndb.transactional
+def _add_cart_entry(nickname, wine_id, price):
+    summary = get_cart_summary(nickname)
+    summary.count += 1
+    summary.total_cents += price
+    entry = CartEntry(parent=cart_key(nickname), wine_id=wine_id,
+                      owner=nickname)
+    ndb.put_multi([entry, summary])
+    return summary
+
+
+@ndb.transactional
+def remove_cart_entries(nickname, entry_ids):
+    """Deletes the given entries of `nickname`'s cart in one batch.
+
+    Returns the updated CartSummary.
+    """
+    summary = get_cart_summary(nickname)
+    keys = [ndb.Key(CartEntry, i, parent=cart_key(nickname))
+            for i in entry_ids]
+    entries = [e for e in ndb.get_multi(keys) if e is not None]
+    prices = current_prices(e.wine_id for e in entries)
+
+    summary.count = max(0, summary.count - len(entries))
+    summary.total_cents -= sum(prices.get(e.wine_id, 0) for e in entries)
+    # Catalog prices may have moved since the entries were added.
+    if summary.count == 0 or summary.total_cents < 0:
+        summary.total_cents = 0
+
+    futures = ndb.delete_multi_async([e.key for e in entries])
+    futures.append(summary.put_async())
+    ndb.Future.wait_all(futures)
+    return summary
+
+
+@ndb.non_transactional
+def current_prices(wine_ids):
+    """Returns id -> price in cents, read outside any running transaction."""
+    ws = get_wine_dicts(wine_ids)
+    return dict((wine_id, price_cents(wine['price']))
+                for wine_id, wine in ws.items())
+
+
+@ndb.transactional(xg=True)
+def checkout_cart(nickname):
+    """Turns `nickname`'s cart into a Sales record, atomically.
+
+    Spans two entity groups (the cart and the buyer's sales shard); the
+    entries are deleted with one batch and the sale written alongside, so
+    the cost does not grow with the number of RPCs per cart entry.
+    """
+    entries = CartEntry.get_from_nickname(name=nickname,
+                                          ancestor=cart_key(nickname))
+    if not entries:
+        return None
+
+    counts = collections.OrderedDict()
+    for e in entries:
+        counts[e.wine_id] = counts.get(e.wine_id, 0) + 1
+    prices = current_prices(counts.keys())
+
+    sale = Sales(parent=sales_shard_key(nickname))
+    sale.owner = nickname
+    sale.items = [SaleItem(wine_id=wine_id, quantity=quantity,
+                           unit_price_cents=prices.get(wine_id, 0))
+                  for wine_id, quantity in counts.items()]
+    sale.price = sum(i.quantity * i.unit_price_cents for i in sale.items)
+    sale.timestamp = int(time.time())
+
+    futures = ndb.delete_multi_async([e.key for e in entries])
+    futures.append(sale.put_async())
+    futures.append(CartSummary(key=cart_summary_key(nickname)).put_async())
+    ndb.Future.wait_all(futures)
+    deferred.defer(record_sale_rollups, sale.key, _transactional=True)
+    return sale
+
+
+# Sales rollups.
+#
+# Each sale adds its bottles and revenue to per-wine, per-winery and
+# per-day counters for the day it happened, so /api/sales reads a few
+# counters per day instead of replaying the whole sales history. The wine
+# and winery counters are also kept per month and for all time (day
+# ALL_DAYS), so a range reads whole months plus the days at either end.
+# Every counter is split into NUM_ROLLUP_SHARDS entities to spread the
+# writes.
+NUM_ROLLUP_SHARDS = 10
+ROLLUP_DIMENSIONS = ('wine', 'winery', 'day')
+ROLLUP_BATCH_SIZE = 20
+ALL_DAYS = u'all'
+# Days of the per-day series /api/sales returns when no range is given.
+DEFAULT_SALES_DAYS = 90
+# Longest range /api/sales accepts, in days.
+MAX_SALES_RANGE_DAYS = 366
+# Counters read per bucket for one page of wine or winery totals. At most
+# NUM_ROLLUP_SHARDS of them share a value, so a page always makes progress.
+ROLLUP_PAGE_SIZE = 200
+
+
+def price_cents(price):
+    cents = parse_number(price, 100)
+    return 0 if cents is None else cents
+
+
+def sale_day(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def rollup_key(dimension, value, day, shard):
+    return ndb.Key(SalesRollup,
+                   u'%s|%s|%s|%d' % (dimension, value, day, shard))
+
+
+def sale_rollup_deltas(sale):
+    """Returns the {(dimension, value): [bottles, cents]} a sale adds."""
+    items = sale.line_items()
+    ws = get_wine_dicts(item.wine_id for item in items)
+    day = sale_day(sale.timestamp)
+
+    deltas = collections.defaultdict(lambda: [0, 0])
+    for item in items:
+        if item.wine_id not in ws:
+            continue
+        wine = ws[item.wine_id]
+        number = item.quantity
+        cents = number * item.unit_cents(wine)
+        for dimension, value in (('wine', unicode(item.wine_id)),
+                                 ('winery', wine['winery'] or u''),
+                                 ('day', day)):
+            delta = deltas[(dimension, value)]
+            delta[0] += number
+            delta[1] += cents
+    return deltas
+
+
+def record_sale_rollups(sale_key):
+    """Adds a sale to the rollups. Safe to run more than once per sale."""
+    sale = sale_key.get()
+    if sale is None or not sale.line_items():
+        return
+
+    day = sale_day(sale.timestamp)
+    shard = zlib.crc32(sale_key.urlsafe()) % NUM_ROLLUP_SHARDS
+    items = sorted(sale_rollup_deltas(sale).items())
+    coarse = [item for item in items if item[0][0] != 'day']
+    # The month and all-time batches have markers of their own, so
+    # re-running /admin/rollup_sales backfills them for sales rolled up
+    # before.
+    for prefix, rollup_day, batch_items in (('', day, items),
+                                            ('month:', day[:7], coarse),
+                                            ('all:', ALL_DAYS, coarse)):
+        for batch, start in enumerate(range(0, len(batch_items),
+                                            ROLLUP_BATCH_SIZE)):
+            _apply_rollup_batch(sale_key, '%s%d' % (prefix, batch),
+                                rollup_day, shard,
+                                batch_items[start:start + ROLLUP_BATCH_SIZE])
+    SALES_VERSION.bump()
+
+
+@ndb.transactional(xg=True)
+def _apply_rollup_batch(sale_key, batch, day, shard, items):
+    # At most ROLLUP_BATCH_SIZE counters plus the marker: within the limit
+    # of entity groups a cross-group transaction may touch.
+    marker_key = ndb.Key(RollupMarker, '%s:%s' % (sale_key.urlsafe(), batch))
+    keys = [rollup_key(dimension, value, day, shard)
+            for (dimension, value), _ in items]
+    entities = ndb.get_multi([marker_key] + keys)
+    if entities[0] is not None:
+        return
+
+    counters = []
+    for key, item, counter in zip(keys, items, entities[1:]):
+        (dimension, value), (bottles, cents) = item
+        if counter is None:
+            counter = SalesRollup(key=key, dimension=dimension, value=value,
+                                  day=day)
+        counter.bottles += bottles
+        counter.cents += cents
+        counters.append(counter)
+    ndb.put_multi(counters + [RollupMarker(key=marker_key)])
+
+
+def parse_day(day):
+    return datetime.datetime.strptime(day, '%Y-%m-%d').date()
+
+
+def rollup_buckets(start_day, end_day):
+    """Covers [start_day, end_day] with whole months and the days left over.
+
+    Returns the rollup days to read, e.g. 2016-01-30, 2016-01-31, 2016-02,
+    2016-03-01 for 2016-01-30..2016-03-01.
+    """
+    buckets = []
+    day = parse_day(start_day)
+    last = parse_day(end_day)
+    while day <= last:
+        next_month = (day.replace(day=28) + datetime.timedelta(days=4)
+                      ).replace(day=1)
+        if day.day == 1 and next_month - datetime.timedelta(days=1) <= last:
+            buckets.append(unicode(day.strftime('%Y-%m')))
+            day = next_month
+        else:
+            buckets.append(unicode(day.isoformat()))
+            day += datetime.timedelta(days=1)
+    return buckets
+
+
+def read_day_rollups(start_day, end_day):
+    """Sums the per-day counters over [start_day, end_day] by day."""
+    query = SalesRollup.query(SalesRollup.dimension == 'day',
+                              SalesRollup.day >= start_day,
+                              SalesRollup.day <= end_day)
+    sums = collections.defaultdict(lambda: [0, 0])
+    for counter in query.iter(batch_size=500):
+        sums[counter.value][0] += counter.bottles
+        sums[counter.value][1] += counter.cents
+    return sums
+
+
+def read_rollup_page(dimension, buckets, start_value=None):
+    """Sums one page of a dimension's counters over buckets, by value.
+
+    Reads at most ROLLUP_PAGE_SIZE counters per bucket, from start_value
+    on. Returns ({value: [bottles, cents]}, next_value), next_value being
+    the start_value of the next page or None after the last one.
+    """
+    futures = []
+    for bucket in buckets:
+        query = SalesRollup.query(SalesRollup.dimension == dimension,
+                                  SalesRollup.day == bucket)
+        if start_value is not None:
+            query = query.filter(SalesRollup.value >= start_value)
+        futures.append(query.order(SalesRollup.value).fetch_async(
+            ROLLUP_PAGE_SIZE))
+    pages = [f.get_result() for f in futures]
+
+    # A full page may stop partway through the shards of its last value:
+    # that value and everything after it are left for the next page.
+    ends = [page[-1].value for page in pages if len(page) == ROLLUP_PAGE_SIZE]
+    next_value = min(ends) if ends else None
+    sums = collections.defaultdict(lambda: [0, 0])
+    for page in pages:
+        for counter in page:
+            if next_value is None or counter.value < next_value:
+                sums[counter.value][0] += counter.bottles
+                sums[counter.value][1] += counter.cents
+    return sums, next_value
+
+
+# Recommendations.
+#
+# step2 of the pipeline writes, for each wine, the wines bought with it
+# most often: "<wine id>\t<partner id>...\t<times bought together>". An
+# upload becomes a RecommendationSet whose lines are spread by wine id over
+# NUM_RECOMMENDATION_CHUNKS child entities, and is made active by pointing
+# the ActiveRecommendations entity at it. Instances keep the chunks they
+# have read and drop them when RECOMMENDATIONS_VERSION moves, so serving
+# is a dictionary lookup and a set can be swapped in (or back) at any time.
+NUM_RECOMMENDATION_CHUNKS = 64
+MAX_RECOMMENDATIONS = 5
+
+
+class RecommendationSet(ndb.Model):
+    wines = ndb.IntegerProperty(default=0)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def to_dict(self):
+        return {"id": self.key.id(), "wines": self.wines,
+                "created": self.created.isoformat()}
+
+
+class RecommendationChunk(ndb.Model):
+    """{wine id: [[partner ids], times]} for the wines of one chunk."""
+    wines = ndb.JsonProperty(compressed=True, default={})
+
+
+class ActiveRecommendations(ndb.Model):
+    set_id = ndb.IntegerProperty()
+
+
+RECOMMENDATIONS_VERSION = VersionStamp('recommendations')
+
+
+def active_recommendations_key():
+    return ndb.Key(ActiveRecommendations, 'active')
+
+
+def recommendation_chunk_key(set_key, wine_id):
+    return ndb.Key(RecommendationChunk,
+                   str(wine_id % NUM_RECOMMENDATION_CHUNKS), parent=set_key)
+
+
+def parse_recommendations(body):
+    """Parses step2 output into {wine id: [[partner ids], times]}.
+
+    Lines without partners, or that do not parse, are skipped.
+    """
+    wines = {}
+    for line in body.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 3:
+            continue
+        try:
+            wine_id = int(fields[0])
+            partners = [int(f) for f in fields[1:-1] if f.strip() != '']
+            times = int(fields[-1])
+        except ValueError:
+            continue
+        if partners:
+            wines[wine_id] = [partners, times]
+    return wines
+
+
+def store_recommendations(wines):
+    """Writes a new, inactive RecommendationSet and returns its key."""
+    recommendations = RecommendationSet(wines=len(wines))
+    recommendations.put()
+    chunks = {}
+    for wine_id, value in wines.items():
+        key = recommendation_chunk_key(recommendations.key, wine_id)
+        chunks.setdefault(key, {})[str(wine_id)] = value
+    ndb.put_multi([RecommendationChunk(key=key, wines=chunk)
+                   for key, chunk in chunks.items()])
+    return recommendations.key
+
+
+def activate_recommendations(set_key):
+    ActiveRecommendations(key=active_recommendations_key(),
+                          set_id=set_key.id()).put()
+    RECOMMENDATIONS_VERSION.bump()
+
+
+class RecommendationCache(object):
+    """The chunks of the active RecommendationSet read by this instance."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.set_key = None
+        self.chunks = {}
+
+    def current_set(self):
+        version = RECOMMENDATIONS_VERSION.get()[0]
+        if version != self.version:
+            active = active_recommendations_key().get()
+            with self.lock:
+                self.version = version
+                self.set_key = (ndb.Key(RecommendationSet, active.set_id)
+                                if active else None)
+                self.chunks = {}
+        return self.set_key
+
+    def lookup_many(self, wine_ids):
+        """Returns {wine id: ([partner ids], times bought together)}.
+
+        Checks the version once and reads the chunks this instance does
+        not hold yet in one get_multi; the rest are dictionary lookups.
+        """
+        set_key = self.current_set()
+        if set_key is None:
+            return {}
+        keys = dict((wine_id, recommendation_chunk_key(set_key, wine_id))
+                    for wine_id in set(wine_ids))
+        chunks = self.chunks
+        missing = list(set(key for key in keys.values() if key not in chunks))
+        loaded = {}
+        if missing:
+            for key, entity in zip(missing, ndb.get_multi(missing)):
+                loaded[key] = entity.wines if entity else {}
+            with self.lock:
+                if self.set_key == set_key:
+                    self.chunks.update(loaded)
+
+        found = {}
+        for wine_id, key in keys.items():
+            chunk = loaded[key] if key in loaded else chunks[key]
+            found[wine_id] = chunk.get(str(wine_id), ([], 0))
+        return found
+
+    def bought_with(self, wine_ids, limit=MAX_RECOMMENDATIONS):
+        """Returns the ids most often bought with any of `wine_ids`."""
+        return self.rank(self.lookup_many(wine_ids), wine_ids, limit)
+
+    @staticmethod
+    def rank(found, wine_ids, limit=MAX_RECOMMENDATIONS):
+        """Ranks the partners of `wine_ids` out of a lookup_many result."""
+        scores = collections.Counter()
+        for wine_id in wine_ids:
+            partners, times = found.get(wine_id, ([], 0))
+            for partner in partners:
+                scores[partner] += times
+        for wine_id in wine_ids:
+            scores.pop(wine_id, None)
+        return [partner for partner, _ in
+                sorted(scores.items(), key=lambda p: (-p[1], p[0]))[:limit]]
+
+
+RECOMMENDATIONS = RecommendationCache()
+
+
+# Sales export.
+#
+# Writes sales as the CSV that pipeline/main.py reads (PIPELINE_COLUMNS),
+# one row per line item with the wine's catalog fields joined in. Sales
+# are walked in timestamp order with a query cursor, one bounded page per
+# request, and each page links to the next. Incremental exports resume
+# where the last completed one ended and stop EXPORT_SETTLE_SECONDS in
+# the past, which leaves the timestamp index time to catch up.
+PIPELINE_COLUMNS = ['Index', 'Country', 'Description', 'Designation',
+                    'Points', 'Price', 'Province', 'Region_1', 'Region_2',
+                    'Variety', 'Winery', 'Quantity', 'User', 'DateTime']
+EXPORT_PAGE_SIZE = 500
+EXPORT_SETTLE_SECONDS = 300
+
+
+class SalesExportCheckpoint(ndb.Model):
+    """End (exclusive timestamp) of the last completed incremental export."""
+    exported_until = ndb.IntegerProperty(default=0)
+
+
+def export_checkpoint_key():
+    return ndb.Key(SalesExportCheckpoint, 'sales')
+
+
+def fetch_sales_page(start_ts, end_ts, page_size, start_cursor=None):
+    """Returns (sales in [start_ts, end_ts) by timestamp, next cursor)."""
+    query = Sales.query(Sales.timestamp >= start_ts,
+                        Sales.timestamp < end_ts).order(Sales.timestamp)
+    sales, next_cursor, more = query.fetch_page(page_size,
+                                                start_cursor=start_cursor)
+    return sales, next_cursor if more else None
+
+
+def sales_export_rows(sales):
+    """Yields the pipeline CSV lines of `sales`, one per line item.
+
+    The pipeline reads Price as whole dollars and treats the bottles
+    sharing a DateTime as one purchase.
+    """
+    items_by_sale = [g.line_items() for g in sales]
+    ws = get_wine_dicts(item.wine_id for items in items_by_sale
+                        for item in items)
+
+    out = StringIO.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for g, items in zip(sales, items_by_sale):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(g.timestamp))
+        for item in items:
+            wine = ws.get(item.wine_id)
+            if wine is None:
+                continue
+            dollars = int(round(item.unit_cents(wine) / 100.0))
+            row = [item.wine_id, wine['country'], u'', u'', u'', dollars,
+                   u'', wine['region'], u'', wine['variety'], wine['winery'],
+                   item.quantity, g.owner, when]
+            writer.writerow([unicode(u'' if v is None else v).encode('utf-8')
+                             for v in row])
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+
+
 # [START main_page]
 class MainPage(webapp2.RequestHandler):
+    @ndb.toplevel
     def get(self):
         guestbook_name = self.request.get('guestbook_name',
                                           DEFAULT_GUESTBOOK_NAME)
         greetings_query = Greeting.query(
             ancestor=guestbook_key(guestbook_name)).order(-Greeting.date)
-        greetings = greetings_query.fetch(10)
+        # Runs while the login/logout URL is being built.
+        greetings_future = greetings_query.fetch_async(10)
 
         user = users.get_current_user()
         if user:
@@ -147,26 +1565,21 @@ class MainPage(webapp2.RequestHandler):
 
         template_values = {
             'user': user,
-            'greetings': greetings,
+            'greetings': greetings_future.get_result(),
             'guestbook_name': urllib.quote_plus(guestbook_name),
             'url': url,
             'url_linktext': url_linktext,
         }
 
-        template = JINJA_ENVIRONMENT.get_template('index.html')
-        self.response.write(template.render(template_values))
+        self.response.write(render_template('index.html', template_values))
 # [END main_page]
 
 
 # [START guestbook]
 class NewWine(webapp2.RequestHandler):
     def post(self):
-        # We set the same parent key on the 'Greeting' to ensure each
-        # Greeting is in the same entity group. Queries across the
-        # single entity group will be consistent. However, the write
-        # rate to a single entity group should be limited to
-        # ~1/second.
-        greeting = Wine(parent=wine_key())
+        # The key picks one of the wine shards, see new_wine_keys().
+        greeting = Wine(key=new_wine_key())
 
         #if users.get_current_user():
         #    greeting.author = Author(
@@ -184,271 +1597,875 @@ class NewWine(webapp2.RequestHandler):
             greeting.wine_price = remove_accent(self.request.get('wine_price'))
 
             greeting.put()
+            record_field_values([greeting])
+            CATALOG_CACHE.invalidate()
             self.redirect('/?new_wine=true')
         else: 
             self.redirect('/?new_wine=false')
 # [END guestbook]
 
+
+# Bulk import.
+#
+# Accepts CSV (with a header row) or JSON lines. Columns may be named
+# after the Wine properties ('wine_country') or without the prefix
+# ('country'). Records are normalized and validated once, then written
+# with put_multi; large files are split into task queue chunks whose
+# progress is tracked on an ImportJob.
+WINE_FIELDS = ['wine_type', 'wine_country', 'wine_region', 'wine_variety',
+               'wine_winery', 'wine_year', 'wine_price']
+IMPORT_BATCH_SIZE = 500
+IMPORT_TASK_ROWS = 200
+IMPORT_MAX_ERRORS = 100
+# Indexed strings (the normalized copies of the fields) are limited to
+# 1500 bytes.
+MAX_FIELD_BYTES = 1500
+# The record keys wine_from_record reads: 'wine_country' or 'country'.
+IMPORT_COLUMNS = set(WINE_FIELDS +
+                     [prop[len('wine_'):] for prop in WINE_FIELDS])
+
+
+class ImportJob(ndb.Model):
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    imported = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    errors = ndb.JsonProperty(default=[])
+    chunks_done = ndb.IntegerProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def to_dict(self):
+        return {"job": self.key.id(), "total": self.total,
+                "imported": self.imported, "failed": self.failed,
+                "done": self.imported + self.failed >= self.total,
+                "errors": self.errors}
+
+
+def parse_import(body, fmt):
+    """Returns [(row number, record dict or error message)] for `body`.
+
+    Records keep only the IMPORT_COLUMNS, which also keeps extra columns
+    out of the task queue payloads.
+    """
+    rows = []
+    if fmt == 'jsonl':
+        for number, line in enumerate(body.splitlines(), 1):
+            if line.strip() == '':
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = 'Invalid JSON.'
+            if isinstance(record, dict):
+                record = dict((k, v) for k, v in record.items()
+                              if k in IMPORT_COLUMNS)
+            elif not isinstance(record, basestring):
+                record = 'Expected a JSON object.'
+            rows.append((number, record))
+    else:
+        reader = csv.DictReader(body.splitlines())
+        for number, record in enumerate(reader, 2):
+            try:
+                record = dict((k, v.decode('utf-8') if v is not None else None)
+                              for k, v in record.items()
+                              if k in IMPORT_COLUMNS)
+            except UnicodeDecodeError:
+                record = 'Invalid UTF-8.'
+            rows.append((number, record))
+    return rows
+
+
+def wine_from_record(record):
+    """Builds a Wine from an import record, or raises ValueError.
+
+    Anything that would make the put fail (numbers that do not fit an
+    IntegerProperty, values over the indexed string limit) is a ValueError
+    here, so one bad row never fails its whole chunk.
+    """
+    wine = Wine()
+    for prop in WINE_FIELDS:
+        value = record.get(prop, record.get(prop[len('wine_'):]))
+        if value is None or unicode(value).strip() == u'':
+            raise ValueError('Missing %s.' % prop)
+        value = remove_accent(unicode(value).strip())
+        if len(value.encode('utf-8')) > MAX_FIELD_BYTES:
+            raise ValueError('%s is too long.' % prop)
+        setattr(wine, prop, value)
+    if parse_number(wine.wine_year) is None:
+        raise ValueError('Invalid wine_year.')
+    if parse_number(wine.wine_price, 100) is None:
+        raise ValueError('Invalid wine_price.')
+    return wine
+
+
+def import_wines(rows, wine_ids=None):
+    """Writes the valid rows. Returns (imported count, [error dicts]).
+
+    `wine_ids`, one per row, makes the import idempotent: a retried chunk
+    overwrites the same wines instead of adding new ones.
+    """
+    if wine_ids is None:
+        keys = new_wine_keys(len(rows)) if rows else []
+    else:
+        keys = [sharded_wine_key(wine_id) for wine_id in wine_ids]
+
+    wines = []
+    errors = []
+    for (number, record), key in zip(rows, keys):
+        try:
+            if isinstance(record, basestring):
+                raise ValueError(record)
+            wine = wine_from_record(record)
+        except ValueError as e:
+            errors.append({"row": number, "error": str(e)})
+            continue
+        wine.key = key
+        wines.append(wine)
+
+    if wines:
+        for start in range(0, len(wines), IMPORT_BATCH_SIZE):
+            ndb.put_multi(wines[start:start + IMPORT_BATCH_SIZE])
+        record_field_values(wines)
+        CATALOG_CACHE.invalidate()
+    return len(wines), errors
+
+
+@ndb.transactional
+def record_import_progress(job_key, chunk, imported, errors):
+    job = job_key.get()
+    if chunk in job.chunks_done:
+        return
+    job.chunks_done.append(chunk)
+    job.imported += imported
+    job.failed += len(errors)
+    job.errors = (job.errors + errors)[:IMPORT_MAX_ERRORS]
+    job.put()
+
+
+class BulkImport(webapp2.RequestHandler):
+    """POST a catalog file to import it; GET ?job=<id> for progress.
+
+    The format comes from the 'format' parameter ('csv' or 'jsonl') or
+    else the Content-Type. Files over IMPORT_TASK_ROWS rows, or any file
+    posted with async=1, are imported through the task queue.
+    """
+    def get(self):
+        try:
+            job = ImportJob.get_by_id(long(self.request.get('job')))
+        except ValueError:
+            job = None
+        if job is None:
+            self.abort(404)
+        self.write_json(job.to_dict())
+
+    def post(self):
+        fmt = self.request.get('format')
+        if fmt == '':
+            content_type = self.request.content_type or ''
+            fmt = 'jsonl' if 'json' in content_type else 'csv'
+        if fmt not in ('csv', 'jsonl'):
+            self.abort(400, 'Unknown format.')
+
+        rows = parse_import(self.request.body, fmt)
+        if len(rows) <= IMPORT_TASK_ROWS and self.request.get('async') == '':
+            imported, errors = import_wines(rows)
+            self.write_json({"total": len(rows), "imported": imported,
+                             "failed": len(errors), "done": True,
+                             "errors": errors[:IMPORT_MAX_ERRORS]})
+            return
+
+        job = ImportJob(total=len(rows))
+        job.put()
+        first, _ = Wine.allocate_ids(max(1, len(rows)))
+        tasks = []
+        for start in range(0, len(rows), IMPORT_TASK_ROWS):
+            tasks.append(taskqueue.Task(
+                url='/admin/import/task',
+                params={'job': job.key.id(),
+                        'chunk': start,
+                        'first_id': first + start,
+                        'rows': json.dumps(rows[start:start + IMPORT_TASK_ROWS])}))
+        for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+        self.response.status_int = 202
+        self.write_json(job.to_dict())
+
+    def write_json(self, value):
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(value, ensure_ascii=False))
+
+
+class BulkImportTask(webapp2.RequestHandler):
+    def post(self):
+        rows = json.loads(self.request.get('rows'))
+        first_id = long(self.request.get('first_id'))
+        imported, errors = import_wines(
+            rows, range(first_id, first_id + len(rows)))
+        record_import_progress(ndb.Key(ImportJob, long(self.request.get('job'))),
+                               int(self.request.get('chunk')), imported, errors)
+
 class Carthdl(webapp2.RequestHandler):
+    """The current user's cart.
+
+    GET returns a page of it; POST (add a wine) and DELETE (remove entries
+    or check out) answer with the updated cart the same way, so a client
+    never needs a second request to refresh it.
+    """
+    @ndb.toplevel
     def post(self):
-        greeting = CartEntry(parent=cart_key())
         user = users.get_current_user()
-        url = None
-        url_linktext = None
-        nickname = None
-                            
-        if user:
-            url = users.create_logout_url(self.request.uri)
-            nickname = user.nickname()
-            url_linktext = 'Logout'
-        else:
-            url = users.create_login_url(self.request.uri)
-            url_linktext = 'Login'
-        
-        if self.request.get('wine_id') != '' and nickname != None:
-            greeting.wine_id = int(self.request.get('wine_id'))
-            greeting.owner = nickname
-            greeting.put()
-            print("Wine added to cart")
+        summary = None
+
+        if user and self.request.get('wine_id') != '':
+            try:
+                wine_id = int(self.request.get('wine_id'))
+            except ValueError:
+                self.abort(400, 'Invalid wine id.')
+            summary = add_to_cart(user.nickname(), wine_id)
 
-        self.redirect('/')
+        self.write_cart(user, summary)
 
+    @ndb.toplevel
     def get(self):
+        self.write_cart(users.get_current_user())
+
+    @ndb.toplevel
+    def delete(self):
         user = users.get_current_user()
-        url = None
-        url_linktext = None
-        nickname = None
-         
+        summary = None
+
         if user:
             nickname = user.nickname()
-            url_linktext = 'Logout'
-        else:
-            url = users.create_login_url(self.request.uri)
-            url_linktext = 'Login'
 
+            if self.request.get('checkout') != '':
+                if checkout_cart(nickname) is not None:
+                    SALES_VERSION.bump()
+                summary = CartSummary()
+            else:
+                # 'ids' is a comma-separated list; 'id' is kept for old clients.
+                ids = self.request.get('ids') or self.request.get('id')
+                try:
+                    entry_ids = [long(i) for i in ids.split(',') if i != '']
+                except ValueError:
+                    self.abort(400, 'Invalid cart entry id.')
+                summary = remove_cart_entries(nickname, entry_ids)
+
+        self.write_cart(user, summary)
+
+    def write_cart(self, user, summary=None):
         ret = []
+        next_cursor = None
+        page_size, cursor = page_request(self.request, default=MAX_PAGE_SIZE)
 
         if user:
-            greetings_query = CartEntry.get_from_nickname(name=nickname, ancestor=cart_key())
-            greetings = greetings_query
-        
-            wines_query = Wine.query(ancestor=wine_key())
-            wines = wines_query.fetch()
+            # The cart page and its summary are independent reads: start
+            # both before waiting on either.
+            nickname = user.nickname()
+            contents = cart_contents_async(nickname, page_size, cursor)
+            if summary is None:
+                summary = get_cart_summary_async(nickname).get_result()
+            ret, next_cursor = contents.get_result()
+        if summary is None:
+            summary = CartSummary()
 
-            ws = {}
-            for w in wines:
-                ws[w.key.id()] = {"wine_id":w.key.id(), "type": w.wine_type, "country": w.wine_country, "region": w.wine_region, "variety": w.wine_variety, "winery": w.wine_winery, "year": w.wine_year, "price":w.wine_price}
+        for item in ret:
+            item["line_total"] = len(item["cart_entry"]) * \
+                price_cents(item["wine"]["price"]) / 100.0
 
-            already_in_cart = {}
-            for w in greetings:
-                if w.wine_id in ws and w.wine_id not in already_in_cart:
-                    ret.append({"wine": ws[w.wine_id], "cart_entry":[w.key.id()]})
-                    already_in_cart[w.wine_id] = len(ret)-1
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps({"items": ret,
+                                        "next_cursor": next_cursor,
+                                        "summary": summary.to_dict()},
+                                       ensure_ascii=False))
 
-                elif w.wine_id in ws:
-                    ret[already_in_cart[w.wine_id]]["cart_entry"].append(w.key.id())
 
+class CatalogCacheStats(webapp2.RequestHandler):
+    def get(self):
         self.response.content_type = "application/json"
-        self.response.write(json.dumps(ret, ensure_ascii=False))
+        self.response.write(json.dumps(
+            dict(CATALOG_CACHE.stats, version=CATALOG_CACHE.version,
+                 local_entries=len(CATALOG_CACHE.wines))))
 
-    def delete(self): 
-        user = users.get_current_user()
-        url = None
-        url_linktext = None
-        nickname = None
 
+class CartSummaryAPI(webapp2.RequestHandler):
+    def get(self):
+        user = users.get_current_user()
+        summary = CartSummary()
         if user:
-            url = users.create_logout_url(self.request.uri)
-            nickname = user.nickname()
-            url_linktext = 'Logout'
-                
-            if self.request.get('checkout') != '':
-                user = users.get_current_user()
-                url = None
-                url_linktext = None
-                nickname = None
-                            
-                if user:
-                    url = users.create_logout_url(self.request.uri)
-                    nickname = user.nickname()
-                    url_linktext = 'Logout'
-                else:
-                    url = users.create_login_url(self.request.uri)
-                    url_linktext = 'Login'
-        
-                if self.request.get('wine_id') != '' and nickname != None:
-                    greeting.wine_id = int(self.request.get('wine_id'))
-                    greeting.owner = nickname
-                    greeting.put()
-
-                entries = CartEntry.get_from_nickname(name=nickname, ancestor=cart_key())
-                greeting = Sales(parent=sales_key())
-                greeting.owner = nickname
-                ids_wine_to_save = []
-                for e in entries:
-                    ids_wine_to_save.append(str(e.wine_id))
-                    e.key.delete()
-                greeting.wines_id = ",".join(ids_wine_to_save)
-                greeting.timestamp = int(time.time())
-                greeting.put()
-
-            elif self.request.get('id') != '':
-                entries = CartEntry.get_from_nickname(name=nickname, ancestor=cart_key())
-                c = CartEntry.get_by_id(long(self.request.get('id')), parent=cart_key())
-                if c:
-                    c.key.delete()
+            summary = get_cart_summary(user.nickname())
 
-        else:
-            url = users.create_logout_url(self.request.uri)
-            url_linktext = 'Login'
-
-        self.redirect("/cart")
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(summary.to_dict()))
 
 
 class SalesAPI(webapp2.RequestHandler):
+    """Bottles and revenue per wine, winery and day, from the rollups.
+
+    Optional 'start' and 'end' parameters (YYYY-MM-DD, UTC, inclusive)
+    restrict the days covered, to at most MAX_SALES_RANGE_DAYS. Without
+    them, wines and wineries are all-time totals and days cover the last
+    DEFAULT_SALES_DAYS days. Wines and wineries come a page at a time,
+    ordered by id and name: pass the returned next_cursor as 'cursor' for
+    the next page, which leaves days out.
+    """
+    DAY_FORMAT = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+    PAGED_DIMENSIONS = ('wine', 'winery')
+
     def get(self):
-        greeting = Sales.query(ancestor=sales_key()).fetch()
-        wines = Wine.query(ancestor=wine_key()).fetch()
-        ws = {}
-        for w in wines:
-            ws[w.key.id()] = {"wine_id":w.key.id(), "type": w.wine_type, "country": w.wine_country, "region": w.wine_region, "variety": w.wine_variety, "winery": w.wine_winery, "year": w.wine_year, "price":w.wine_price, "number":0}
+        start = self.request.get('start')
+        end = self.request.get('end')
+        for day in (start, end):
+            if day != '' and not self.DAY_FORMAT.match(day):
+                self.abort(400, 'Days must be formatted as YYYY-MM-DD.')
+        first = last = None
+        try:
+            if end:
+                last = parse_day(end)
+            elif start:
+                last = datetime.datetime.utcnow().date()
+            if start:
+                first = parse_day(start)
+            elif end:
+                first = last - datetime.timedelta(
+                    days=MAX_SALES_RANGE_DAYS - 1)
+        except ValueError:
+            self.abort(400, 'Days must be formatted as YYYY-MM-DD.')
+        if first is not None and (
+                first > last or
+                (last - first).days >= MAX_SALES_RANGE_DAYS):
+            self.abort(400, 'Ranges must cover 1 to %d days.'
+                       % MAX_SALES_RANGE_DAYS)
+
+        if first is None:
+            buckets = [ALL_DAYS]
+        else:
+            buckets = rollup_buckets(first.isoformat(), last.isoformat())
+        cursor = self.request.get('cursor')
+        positions = self.decode_cursor(cursor)
+
+        totals = {}
+        next_positions = {}
+        for dimension in self.PAGED_DIMENSIONS:
+            if cursor and positions.get(dimension) is None:
+                totals[dimension], next_positions[dimension] = {}, None
+                continue
+            totals[dimension], next_positions[dimension] = read_rollup_page(
+                dimension, buckets, positions.get(dimension))
+        if cursor:
+            totals['day'] = {}
+        elif first is None:
+            totals['day'] = read_day_rollups(
+                sale_day(time.time() - (DEFAULT_SALES_DAYS - 1) * 86400),
+                sale_day(time.time()))
+        else:
+            totals['day'] = read_day_rollups(first.isoformat(),
+                                             last.isoformat())
+        ws = get_wine_dicts(long(i) for i in totals['wine'])
+
+        def rows(dimension, label, value_of):
+            ret = []
+            for value, (bottles, cents) in totals[dimension].items():
+                ret.append({label: value_of(value), "bottles": bottles,
+                            "dollars": cents / 100.0})
+            ret.sort(key=lambda row: row["dollars"], reverse=True)
+            return ret
+
+        next_cursor = None
+        if any(v is not None for v in next_positions.values()):
+            next_cursor = base64.urlsafe_b64encode(json.dumps(next_positions))
+        ret = {
+            "start": start or None,
+            "end": end or None,
+            "wines": [r for r in rows('wine', "wine",
+                                      lambda v: ws.get(long(v)))
+                      if r["wine"] is not None],
+            "wineries": rows('winery', "winery", lambda v: v),
+            "days": sorted(rows('day', "day", lambda v: v),
+                           key=lambda row: row["day"]),
+            "next_cursor": next_cursor,
+        }
+
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(ret, ensure_ascii=False))
+
+    def decode_cursor(self, cursor):
+        if cursor == '':
+            return {}
+        try:
+            positions = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            positions = None
+        if not isinstance(positions, dict) or any(
+                not isinstance(positions.get(d), (unicode, type(None)))
+                for d in self.PAGED_DIMENSIONS):
+            self.abort(400, 'Invalid cursor.')
+        return positions
+
+
+class SalesHistoryAPI(webapp2.RequestHandler):
+    def get(self):
+        greeting, next_cursor = fetch_page_sharded(
+            lambda parent: Sales.query(ancestor=parent).order(-Sales.timestamp),
+            sales_shard_keys(), page_size_request(self.request),
+            lambda sale: -sale.timestamp, self.request.get('cursor'))
+
+        items_by_sale = [g.line_items() for g in greeting]
+        ws = get_wine_dicts(item.wine_id for items in items_by_sale
+                            for item in items)
 
         ret = []
-        for g in greeting:
-            if g.wines_id is None:
+        for g, items in zip(greeting, items_by_sale):
+            if not items:
                 continue
-            s = []
             s = {"buyer": g.owner, "timestamp":g.timestamp, "wines":[]}
-            ws_id = g.wines_id.split(",") 
-            already_in_wines = {}
-            
-            for bb in ws_id:
-                if bb is u'':
+            for item in items:
+                if item.wine_id not in ws:
                     continue
-                elif long(bb) in ws and long(bb) not in already_in_wines:
-                    s["wines"].append(copy.deepcopy(ws[long(bb)]))
-                    already_in_wines[long(bb)] = len(s["wines"]) - 1
-                    s["wines"][already_in_wines[long(bb)]]["number"] = 1
-                elif long(bb) in ws:
-                    s["wines"][already_in_wines[long(bb)]]["number"] += 1
-            
+                wine = dict(ws[item.wine_id])
+                wine["number"] = item.quantity
+                wine["unit_price"] = item.unit_cents(wine) / 100.0
+                s["wines"].append(wine)
             ret.append(s)
         
         self.response.content_type = "application/json"
-        self.response.write(json.dumps(ret, ensure_ascii=False))
+        self.response.write(json.dumps(
+            {"items": ret, "next_cursor": next_cursor},
+            ensure_ascii=False))
+
+
+class SalesExport(webapp2.RequestHandler):
+    """Sales as pipeline CSV, one page of sales per request.
+
+    The range is 'start'/'end' (YYYY-MM-DD, UTC, inclusive), 'from'/'until'
+    (timestamps, until excluded) or 'since=last' for everything after the
+    last completed incremental export. While sales remain, the response
+    has a Link header to the next page; 'header=1' adds a header row.
+    """
+    DAY_FORMAT = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+    def get(self):
+        _, cursor = page_request(self.request)
+        incremental = self.request.get('since') == 'last'
+        start_ts, end_ts = self.export_range(incremental)
+
+        sales, next_cursor = fetch_sales_page(start_ts, end_ts,
+                                              EXPORT_PAGE_SIZE, cursor)
+
+        self.response.content_type = 'text/csv'
+        if self.request.get('header') == '1' and cursor is None:
+            self.response.write(','.join(PIPELINE_COLUMNS) + '\n')
+        for line in sales_export_rows(sales):
+            self.response.write(line)
+
+        if next_cursor is not None:
+            params = {'from': start_ts, 'until': end_ts,
+                      'cursor': next_cursor.urlsafe()}
+            if incremental:
+                params['since'] = 'last'
+            self.response.headers['Link'] = '<%s?%s>; rel="next"' % (
+                self.request.path, urllib.urlencode(params))
+        elif incremental:
+            SalesExportCheckpoint(key=export_checkpoint_key(),
+                                  exported_until=end_ts).put()
+
+    def export_range(self, incremental):
+        """Returns the [start, end) timestamps asked for."""
+        try:
+            if self.request.get('from') != '':
+                return (int(self.request.get('from')),
+                        int(self.request.get('until')))
+        except ValueError:
+            self.abort(400, "'from' and 'until' must be timestamps.")
+
+        if incremental:
+            checkpoint = export_checkpoint_key().get()
+            return (checkpoint.exported_until if checkpoint else 0,
+                    int(time.time()) - EXPORT_SETTLE_SECONDS)
+
+        start = self.request.get('start')
+        end = self.request.get('end')
+        for day in (start, end):
+            if day != '' and not self.DAY_FORMAT.match(day):
+                self.abort(400, 'Days must be formatted as YYYY-MM-DD.')
+        start_ts = calendar.timegm(time.strptime(start, '%Y-%m-%d')) \
+            if start else 0
+        end_ts = calendar.timegm(time.strptime(end, '%Y-%m-%d')) + 86400 \
+            if end else int(time.time()) + 1
+        return start_ts, end_ts
 
 
 class NewEntry(webapp2.RequestHandler):
     def get(self):
         template_values = {}
-        template = JINJA_ENVIRONMENT.get_template('new_entry.html')
-        self.response.write(template.render(template_values))
+        self.response.write(render_template('new_entry.html', template_values))
 
 class Display(webapp2.RequestHandler):
     def get(self):
-        wine_category = remove_accent(self.request.get('wine_type'))
-        wine_country = remove_accent(self.request.get('wine_country'))
-        wine_region = remove_accent(self.request.get('wine_region'))
-        wine_variety = remove_accent(self.request.get('wine_variety'))
-        wine_winery = remove_accent(self.request.get('wine_winery'))
-        wine_year = remove_accent(self.request.get('wine_year'))
-        
-        greetings_query = Wine.query(ancestor=wine_key())
-        greetings = greetings_query.fetch()
+        page_size, cursor = page_request(self.request,
+                                         default=DISPLAY_PAGE_SIZE)
+        wines, next_cursor = Wine.search(
+            search_criteria(self.request), page_size, start_cursor=cursor,
+            ranges=range_criteria(self.request),
+            sort=sort_request(self.request))
 
-        wines = []
-
-        for w in greetings:
-            result = True
-            if wine_category is not None and wine_category is not '' and wine_category is not 'all':
-                if w.wine_type is not None:
-                    if wine_category.lower != w.wine_type.lower() and wine_category.lower() not in w.wine_type.lower():
-                        result = False
-                else:
-                    result = False
-            
-            if wine_country is not None and wine_country is not '':
-                if w.wine_country is not None:
-                    if wine_country.lower() not in w.wine_country.lower():
-                        result = False
-                else:
-                    result = False
-            
-            if wine_region is not None:
-                if w.wine_region is not None:
-                    if wine_region.lower() not in w.wine_region.lower():
-                        result = False
-                else:
-                    result = None
-            
-            if wine_variety is not None:
-                if w.wine_variety is not None:
-                    if wine_variety.lower() not in w.wine_variety.lower():
-                        result = False
-                else:
-                    result = None
-            
-            if wine_winery is not None:
-                if w.wine_winery is not None:
-                    if wine_winery.lower() not in w.wine_winery.lower():
-                        result = False
-                else:
-                    result = False
-            
-            try:
-                if wine_year is not None and int(wine_year) > 0 and wine_year is not '':
-                    if w.wine_year is not None:
-                        try:
-                            int(w.wine_year)
-                        except:
-                            result = False
-
-                        if str(wine_year) not in str(w.wine_year):
-                            result = False
-                        else:
-                            print(str(wine_year) + " in " + str(w.wine_year))
-                    else:
-                        result = False
-            except:
-                pass
-
-            if result:
-                wines.append(w)
-        
         message = ''
-        if len(wines) == 0:
+        if len(wines) == 0 and cursor is None:
             message = 'No wine found.'
 
+        next_page_url = None
+        if next_cursor is not None:
+            names = [prop for _, prop in SEARCH_FIELDS] + DISPLAY_PARAMS
+            params = dict((name, self.request.get(name).encode('utf-8'))
+                          for name in names)
+            params['page_size'] = page_size
+            params['cursor'] = next_cursor.urlsafe()
+            next_page_url = '/display?' + urllib.urlencode(params)
+
+        found = RECOMMENDATIONS.lookup_many(w.key.id() for w in wines)
+        bought_with = dict((w.key.id(), RecommendationCache.rank(
+            found, [w.key.id()], limit=3)) for w in wines)
+        ws = get_wine_dicts(i for ids in bought_with.values() for i in ids)
+
         template_values = {
-            'wines': wines[0:10],
-            'message': message
+            'wines': wines,
+            'bought_with': dict((wine_id, [ws[i] for i in ids if i in ws])
+                                for wine_id, ids in bought_with.items()),
+            'message': message,
+            'next_page_url': next_page_url
         }
-        print(message)
-        
-        template = JINJA_ENVIRONMENT.get_template('display.html')
-        self.response.write(template.render(template_values))
+
+        self.response.write(render_template('display.html', template_values))
+
+
+class ReindexWines(webapp2.RequestHandler):
+    """Re-puts every Wine so its search tokens and typed copies are
+    (re)computed, and records its autocomplete values.
+
+    Processes one batch per request and chains itself through the task
+    queue until the catalog is exhausted.
+    """
+    BATCH_SIZE = 200
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor') != '':
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+
+        wines, next_cursor, more = Wine.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(wines)
+        record_field_values(wines)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/reindex',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('%d wines reindexed\n' % len(wines))
+
+    get = post
+
+
+class RollupSales(webapp2.RequestHandler):
+    """Backfills the sales rollups from the recorded sales.
+
+    Chains itself through the task queue like ReindexWines. Rollups are
+    idempotent per sale, so the job can safely be re-run.
+    """
+    BATCH_SIZE = 50
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor') != '':
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+
+        keys, next_cursor, more = Sales.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for key in keys:
+            record_sale_rollups(key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/rollup_sales',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('%d sales rolled up\n' % len(keys))
+
+    get = post
+
+
+class MigrateSales(webapp2.RequestHandler):
+    """Rewrites legacy 'wines_id' sales as priced SaleItems.
+
+    Legacy sales did not record what was paid, so their lines are priced
+    from the current catalog. Chains itself through the task queue.
+    """
+    BATCH_SIZE = 100
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor') != '':
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+
+        sales, next_cursor, more = Sales.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        legacy = [g for g in sales if g.wines_id and not g.items]
+
+        items_by_sale = [g.line_items() for g in legacy]
+        prices = current_prices(item.wine_id for items in items_by_sale
+                                for item in items)
+        for g, items in zip(legacy, items_by_sale):
+            for item in items:
+                item.unit_price_cents = prices.get(item.wine_id, 0)
+            g.items = items
+            g.price = sum(i.quantity * i.unit_price_cents for i in items)
+            g.wines_id = None
+        ndb.put_multi(legacy)
+        if legacy:
+            SALES_VERSION.bump()
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/migrate_sales',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('%d sales migrated\n' % len(legacy))
+
+    get = post
+
+
+@ndb.transactional(xg=True)
+def _move_legacy_cart_entries(owner, keys):
+    """Moves legacy entries into their owner's cart and updates its summary.
+
+    The copies and the deletes commit together, so a retried batch never
+    moves an entry twice.
+    """
+    entries = [e for e in ndb.get_multi(keys) if e is not None]
+    if not entries:
+        return 0
+    summary = get_cart_summary(owner)
+    first, _ = CartEntry.allocate_ids(size=len(entries),
+                                      parent=cart_key(owner))
+    moved = [CartEntry(key=ndb.Key(CartEntry, first + n,
+                                   parent=cart_key(owner)),
+                       wine_id=e.wine_id, owner=owner)
+             for n, e in enumerate(entries)]
+    prices = current_prices(e.wine_id for e in entries)
+    summary.count += len(moved)
+    summary.total_cents += sum(prices.get(e.wine_id, 0) for e in entries)
+    ndb.put_multi(moved + [summary])
+    ndb.delete_multi([e.key for e in entries])
+    return len(moved)
+
+
+class MigrateCarts(webapp2.RequestHandler):
+    """Moves the cart entries left under the legacy shared parent into
+    their owner's cart. Chains itself through the task queue.
+    """
+    BATCH_SIZE = 100
+
+    def post(self):
+        cursor = None
+        if self.request.get('cursor') != '':
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+
+        entries, next_cursor, more = CartEntry.query(
+            ancestor=legacy_cart_key()).fetch_page(self.BATCH_SIZE,
+                                                   start_cursor=cursor)
+        by_owner = collections.defaultdict(list)
+        for e in entries:
+            if e.owner:
+                by_owner[e.owner].append(e.key)
+        moved = 0
+        for owner, keys in by_owner.items():
+            moved += _move_legacy_cart_entries(owner, keys)
+
+        if more and next_cursor:
+            taskqueue.add(url='/admin/migrate_carts',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.write('%d cart entries migrated\n' % moved)
+
+    get = post
+
+
+class Warmup(webapp2.RequestHandler):
+    """Compiles every template and primes the catalog and autocomplete
+    index on new instances."""
+    CATALOG_SIZE = 1000
+
+    def get(self):
+        for name in TEMPLATE_NAMES:
+            JINJA_ENVIRONMENT.get_template(name)
+        CATALOG_CACHE.prime(self.CATALOG_SIZE)
+        AUTOCOMPLETE_INDEX.load(FIELD_VALUES_VERSION.get()[0])
+        self.response.write('warm\n')
+
 
 class Search(webapp2.RequestHandler):
     def get(self):
         template_values={}
-        template = JINJA_ENVIRONMENT.get_template('search.html')
-        self.response.write(template.render(template_values))
+        self.response.write(render_template('search.html', template_values))
 
 
 class Cart(webapp2.RequestHandler):
     def get(self):
         template_values={}
-        template = JINJA_ENVIRONMENT.get_template('cart.html')
-        self.response.write(template.render(template_values))
+        self.response.write(render_template('cart.html', template_values))
 
 class SalesView(webapp2.RequestHandler):
     def get(self):
         template_values = {}
-        template = JINJA_ENVIRONMENT.get_template('sales.html')
-        self.response.write(template.render(template_values))
+        self.response.write(render_template('sales.html', template_values))
+
+# HTTP caching.
+#
+# path -> (Cache-Control, version stamps the response depends on). The
+# ETag combines the deployed version with the stamps, so a repeat GET is
+# answered with 304 Not Modified before any handler runs.
+HTTP_CACHE_RULES = {
+    # Static pages still revalidate, so a deploy that changes the APIs
+    # behind their scripts is picked up at once; the ETag carries the
+    # deployed version, so the check is a 304.
+    '/search': ('public, no-cache', []),
+    '/enter': ('public, no-cache', []),
+    '/cart': ('public, no-cache', []),
+    '/sales': ('public, no-cache', []),
+    '/display': ('public, no-cache',
+                 [CATALOG_VERSION, RECOMMENDATIONS_VERSION]),
+    '/api/sales': ('private, no-cache', [SALES_VERSION, CATALOG_VERSION]),
+    '/api/sales/history': ('private, no-cache',
+                           [SALES_VERSION, CATALOG_VERSION]),
+    '/api/autocomplete': ('public, no-cache', [FIELD_VALUES_VERSION]),
+    '/api/recommendations': ('public, no-cache',
+                             [RECOMMENDATIONS_VERSION, CATALOG_VERSION]),
+}
+
+
+class HTTPCacheMiddleware(object):
+    """Adds ETag/Last-Modified/Cache-Control and answers conditional GETs."""
+
+    def __init__(self, app, rules):
+        self.app = app
+        self.rules = rules
+        self.app_version = os.environ.get('CURRENT_VERSION_ID', 'dev')
+
+    def __call__(self, environ, start_response):
+        rule = self.rules.get(environ.get('PATH_INFO'))
+        if rule is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        cache_control, stamps = rule
+        stamped = VersionStamp.read_all(stamps)
+        etag = '"%s"' % '-'.join([self.app_version] +
+                                 [str(version) for version, _ in stamped])
+        headers = [('ETag', etag), ('Cache-Control', cache_control)]
+        modified = max([m for _, m in stamped if m is not None] or [None])
+        if modified is not None:
+            headers.append(('Last-Modified',
+                            email.utils.formatdate(modified, usegmt=True)))
+
+        if self.not_modified(environ, etag, modified):
+            start_response('304 Not Modified', headers)
+            return []
+
+        def cached_start_response(status, response_headers, exc_info=None):
+            if status.startswith('200'):
+                response_headers = [h for h in response_headers
+                                    if h[0].lower() != 'cache-control']
+                response_headers.extend(headers)
+            return start_response(status, response_headers, exc_info)
+
+        return self.app(environ, cached_start_response)
+
+    def not_modified(self, environ, etag, modified):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and modified is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return modified <= email.utils.mktime_tz(since)
+        return False
+
+
+class RecommendationsAPI(webapp2.RequestHandler):
+    """Wines often bought with ?wine_id=<id>[,<id>...], best first."""
+
+    def get(self):
+        try:
+            wine_ids = [long(i) for i in self.request.get('wine_id').split(',')]
+        except ValueError:
+            webapp2.abort(400)
+        partners = RECOMMENDATIONS.bought_with(wine_ids)
+        ws = get_wine_dicts(partners)
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps({
+            "wine_ids": wine_ids,
+            "recommendations": [ws[i] for i in partners if i in ws],
+        }))
+
+
+class RecommendationsAdmin(webapp2.RequestHandler):
+    """POST step2 output to load and activate it; POST ?activate=<id> to
+    swap back to an earlier set; GET lists the sets."""
+
+    def get(self):
+        active = active_recommendations_key().get()
+        sets = RecommendationSet.query().order(
+            -RecommendationSet.created).fetch(20)
+        self.write_json({"active": active.set_id if active else None,
+                         "sets": [r.to_dict() for r in sets]})
+
+    def post(self):
+        if self.request.get('activate') != '':
+            try:
+                set_key = ndb.Key(RecommendationSet,
+                                  long(self.request.get('activate')))
+            except ValueError:
+                set_key = None
+            if set_key is None or set_key.get() is None:
+                self.abort(404)
+        else:
+            wines = parse_recommendations(self.request.body)
+            if not wines:
+                self.abort(400, 'No recommendations found.')
+            set_key = store_recommendations(wines)
+        activate_recommendations(set_key)
+        self.write_json(set_key.get().to_dict())
+
+    def write_json(self, value):
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(value))
+
+
+class AutocompleteAPI(webapp2.RequestHandler):
+    def get(self):
+        field = self.request.get('field')
+        if field not in AUTOCOMPLETE_FIELDS:
+            webapp2.abort(400)
+        try:
+            limit = int(self.request.get('limit', DEFAULT_SUGGESTIONS))
+        except ValueError:
+            limit = DEFAULT_SUGGESTIONS
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+
+        prefix = self.request.get('q')
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps({
+            "field": field,
+            "q": prefix,
+            "suggestions": AUTOCOMPLETE_INDEX.suggest(field, prefix, limit),
+        }))
+
+
+class MetricsAPI(webapp2.RequestHandler):
+    def get(self):
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps({
+            "routes": app.snapshot(),
+            "catalog_cache": CATALOG_CACHE.stats,
+        }))
+
 
 # [START app]
-app = webapp2.WSGIApplication([
+ROUTES = [
     ('/', MainPage),
     ('/enter', NewEntry),
     ('/add', NewWine),
@@ -456,7 +2473,25 @@ app = webapp2.WSGIApplication([
     ('/search', Search),
     ('/cart', Cart),
     ('/api/sales', SalesAPI),
+    ('/api/sales/history', SalesHistoryAPI),
     ('/api/cart', Carthdl),
-    ('/sales', SalesView)
-], debug=True)
+    ('/api/cart/summary', CartSummaryAPI),
+    ('/api/autocomplete', AutocompleteAPI),
+    ('/api/recommendations', RecommendationsAPI),
+    ('/sales', SalesView),
+    ('/admin/reindex', ReindexWines),
+    ('/admin/catalog_cache', CatalogCacheStats),
+    ('/admin/rollup_sales', RollupSales),
+    ('/admin/migrate_sales', MigrateSales),
+    ('/admin/migrate_carts', MigrateCarts),
+    ('/admin/import', BulkImport),
+    ('/admin/import/task', BulkImportTask),
+    ('/admin/recommendations', RecommendationsAdmin),
+    ('/admin/export/sales', SalesExport),
+    ('/_ah/warmup', Warmup),
+    ('/api/metrics', MetricsAPI)
+]
+application = webapp2.WSGIApplication(ROUTES, debug=DEBUG)
+app = MetricsMiddleware(HTTPCacheMiddleware(application, HTTP_CACHE_RULES),
+                        [path for path, _ in ROUTES])
 # [END app]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2.7
+# Lines per second of the pipeline's input parsing: the per-line regex
+# strip the pipelines used to run, against the shared ParseSales parser.
+#
+#   python bench_parse.py --lines 200000 [--input SubmissionDataset.csv]
+import argparse
+import csv
+import random
+import time
+
+from main import parse_sale
+
+
+def synthetic_lines(count):
+    rng = random.Random(0)
+    lines = []
+    for i in range(count):
+        description = 'Ripe, "juicy" fruit, with a long finish' if i % 2 else 'Crisp and dry'
+        lines.append(','.join([
+            str(rng.randint(0, 100000)), 'France',
+            '"%s"' % description.replace('"', '""'), 'Reserve', '90',
+            str(rng.randint(5, 200)), 'Bordeaux', 'Pauillac', '',
+            rng.choice(['Malbec', 'Red Blend', 'Riesling']),
+            'Chateau %d' % rng.randint(0, 500), str(rng.randint(1, 6)),
+            'user%d' % rng.randint(0, 999), '2017-11-%02d 10:00:00' % (i % 28 + 1)]))
+    return lines
+
+
+def legacy_parse(line):
+    import re
+    t = re.sub('"(.*?)"', '', line)
+    t = t.split(",")
+    return (int(t[0]), t[10], int(t[11]), int(t[11])*int(t[5]))
+
+
+def shared_parse(lines):
+    csv_reader = csv.reader
+    for line in lines:
+        parse_sale(line, csv_reader)
+
+
+def lines_per_second(parse, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        parse(lines)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline CSV parsing.")
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--input', help="Parse this CSV instead of synthetic lines.")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            lines = f.read().splitlines()
+    else:
+        lines = synthetic_lines(args.lines)
+
+    def legacy(lines):
+        for line in lines:
+            try:
+                legacy_parse(line)
+            except (ValueError, IndexError):
+                pass
+
+    before = lines_per_second(legacy, lines, args.repeat)
+    after = lines_per_second(shared_parse, lines, args.repeat)
+    print('regex strip + split: %10.0f lines/s' % before)
+    print('ParseSales:          %10.0f lines/s (x%.2f)' % (after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,268 +18,463 @@ from apache_beam.options.pipeline_options import SetupOptions
 
 #Index,Country,Description,Designation,Points,Price,Province,Region_1,Region_2,Variety,Winery,Quantity,User,DateTime
 
+class SaleRecord(tuple):
+    # One parsed input line. A hand-written named tuple, since this module
+    # may not import collections; __getnewargs__ keeps it picklable.
+    __slots__ = ()
+
+    def __new__(cls, wine_id, country, price, region, variety, winery, quantity, user, datetime):
+        return tuple.__new__(cls, (wine_id, country, price, region, variety, winery, quantity, user, datetime))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    wine_id = property(lambda self: self[0])
+    country = property(lambda self: self[1])
+    price = property(lambda self: self[2])
+    region = property(lambda self: self[3])
+    variety = property(lambda self: self[4])
+    winery = property(lambda self: self[5])
+    quantity = property(lambda self: self[6])
+    user = property(lambda self: self[7])
+    datetime = property(lambda self: self[8])
+
+
+def parse_sale(line, csv_reader):
+    # Returns the SaleRecord of a line, or None if it does not parse (such
+    # as a header row). Lines without quotes take the plain split; quoted
+    # fields, which may hold commas, go through the csv module.
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    if '"' in line:
+        t = next(csv_reader([line]), [])
+    else:
+        t = line.split(",")
+    if len(t) < 14:
+        return None
+    try:
+        return SaleRecord(int(t[0]), t[1], int(t[5]), t[7], t[9], t[10], int(t[11]), t[12], t[13])
+    except ValueError:
+        return None
+
+
+class ParseSales(beam.DoFn):
+    # The shared first stage of every pipeline: lines in, SaleRecords out.
+    # Lines that do not parse are counted in the dropped_rows metric and
+    # the first MAX_LOGGED_DROPS of each bundle are logged.
+    MAX_LOGGED_DROPS = 5
+
+    def __init__(self):
+        beam.DoFn.__init__(self)
+        self.dropped_rows = beam.metrics.Metrics.counter('ParseSales', 'dropped_rows')
+
+    def start_bundle(self):
+        import csv
+        self.csv_reader = csv.reader
+        self.logged_drops = 0
+
+    def process(self, line):
+        sale = parse_sale(line, self.csv_reader)
+        if sale is not None:
+            yield sale
+            return
+        self.dropped_rows.inc()
+        if self.logged_drops < self.MAX_LOGGED_DROPS:
+            import logging
+            self.logged_drops += 1
+            logging.warning('Dropped a sales line that does not parse: %r', line[:200])
+
+
+# Baskets wider than this only pair up their MAX_BASKET_WINES lowest wine
+# ids, which bounds the pairs a basket expands to. At most
+# MAX_TIED_PARTNERS of the partners tied for best are kept per wine.
+MAX_BASKET_WINES = 100
+MAX_TIED_PARTNERS = 50
+# Cap on the association rules written, best lift first.
+MAX_RULES = 10000
+
+
+class BasketWines(beam.CombineFn):
+    # The distinct wines of a purchase, as a sorted list.
+
+    def create_accumulator(self):
+        return set()
+
+    def add_input(self, wines, wine_id):
+        wines.add(wine_id)
+        return self.bound(wines)
+
+    def merge_accumulators(self, accumulators):
+        wines = set()
+        for other in accumulators:
+            wines |= other
+        return self.bound(wines)
+
+    def extract_output(self, wines):
+        return sorted(wines)
+
+    @staticmethod
+    def bound(wines):
+        if len(wines) > MAX_BASKET_WINES:
+            return set(sorted(wines)[:MAX_BASKET_WINES])
+        return wines
+
+
+class BestPartners(beam.CombineFn):
+    # Streaming max over (partner, times bought together): the best count
+    # and the partners reaching it, lowest ids first. A None partner only
+    # registers the wine.
+
+    def create_accumulator(self):
+        return (0, [])
+
+    def add_input(self, best, link):
+        (partner, n) = link
+        return self.keep_best(best, (n, [] if partner is None else [partner]))
+
+    def merge_accumulators(self, accumulators):
+        best = (0, [])
+        for other in accumulators:
+            best = self.keep_best(best, other)
+        return best
+
+    def extract_output(self, best):
+        return best
+
+    @staticmethod
+    def keep_best(a, b):
+        if a[0] != b[0]:
+            return a if a[0] > b[0] else b
+        return (a[0], sorted(set(a[1]) | set(b[1]))[:MAX_TIED_PARTNERS])
+
+
+def write_ranked(totals, args, output, label=''):
+    # Writes (key, total) pairs as "key\ttotal". With --top N, the N largest
+    # come from a Top combiner (lifted, so each worker only ships its own N)
+    # and with --sorted, all of them are sorted on one worker; both write
+    # a single file, largest first. Otherwise the output stays sharded and
+    # unordered.
+    def format(line):
+        (word, count) = line
+        return '%s\t%s' % (word, count)
+
+    if args.top:
+        totals = (totals
+            | 'Top' + label >> beam.combiners.Top.Of(args.top, key=lambda total: total[1])
+            | 'Unpack' + label >> beam.FlatMap(lambda top: top))
+    elif args.sorted:
+        totals = (totals
+            | 'Gather' + label >> beam.combiners.ToList()
+            | 'Sort' + label >> beam.FlatMap(lambda all_totals: sorted(all_totals, key=lambda total: total[1], reverse=True)))
+
+    output_lines = totals | 'Format' + label >> beam.Map(format)
+    if args.top or args.sorted:
+        output_lines | 'Write' + label >> WriteToText(output, num_shards=1)
+    else:
+        output_lines | 'Write' + label >> WriteToText(output)
+
+
 def bottles_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
 
-        def partition_csv(line):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            return (int(t[0]), int(t[11]))
-
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
+        def partition_csv(sale):
+            return (sale.wine_id, sale.quantity)
 
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.Map(partition_csv)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def dollars_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
 
-        def partition_csv(line):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            return (int(t[0]), int(t[11])*int(t[5]))
-
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
+        def partition_csv(sale):
+            return (sale.wine_id, sale.quantity*sale.price)
 
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.Map(partition_csv)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def winery_bottles_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
 
-        def partition_csv(line):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            return (t[10], int(t[11]))
-
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
+        def partition_csv(sale):
+            return (sale.winery, sale.quantity)
 
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.Map(partition_csv)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def winery_dollars_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
 
-        def partition_csv(line):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            return (t[10], int(t[11])*int(t[5]))
-
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
+        def partition_csv(sale):
+            return (sale.winery, sale.quantity*sale.price)
 
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.Map(partition_csv)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def variety_bottles_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
         
-        def filter_using_variety(line, variety):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            if t[9] == variety:
-                yield (int(t[0]), int(t[11])) 
+        def filter_using_variety(sale, variety):
+            if sale.variety == variety:
+                yield (sale.wine_id, sale.quantity)
 
         def mapping(sale):
             return (sale[0], sale[1])
 
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
-
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.FlatMap(filter_using_variety, args.variety)
             | 'Mapping' >> beam.Map(mapping)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def variety_dollars_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
         
-        def filter_using_variety(line, variety):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            if t[9] == variety:
-                yield (int(t[0]), int(t[5])*int(t[11])) 
+        def filter_using_variety(sale, variety):
+            if sale.variety == variety:
+                yield (sale.wine_id, sale.price*sale.quantity)
 
         def mapping(sale):
             return (sale[0], sale[1])
 
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
-
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.FlatMap(filter_using_variety, args.variety)
             | 'Mapping' >> beam.Map(mapping)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def variety_winery_bottles_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
         
-        def filter_using_variety(line, variety):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            if t[9] == variety:
-                yield (str(t[10]), int(t[11])) 
+        def filter_using_variety(sale, variety):
+            if sale.variety == variety:
+                yield (sale.winery, sale.quantity)
 
         def mapping(sale):
             return (sale[0], sale[1])
 
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
-
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.FlatMap(filter_using_variety, args.variety)
             | 'Mapping' >> beam.Map(mapping)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
 
-        output | WriteToText(args.output)
+        write_ranked(output, args, args.output)
 
 def variety_winery_dollars_sold(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
 
         lines = p | ReadFromText(args.input)
         
-        def filter_using_variety(line, variety):
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            if t[9] == variety:
-                yield (str(t[10]), int(t[5])*int(t[11])) 
+        def filter_using_variety(sale, variety):
+            if sale.variety == variety:
+                yield (sale.winery, sale.price*sale.quantity)
 
         def mapping(sale):
             return (sale[0], sale[1])
 
-        def format(line):
-            (word, count) = line
-            return '%s\t%s' % (word, count)
-
         output = (lines 
+            | 'Parse' >> beam.ParDo(ParseSales())
             | 'Partition' >> beam.FlatMap(filter_using_variety, args.variety)
             | 'Mapping' >> beam.Map(mapping)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)
-            | 'Format' >> beam.Map(format))
+            | 'GroupAndSum' >> beam.CombinePerKey(sum))
+
+        write_ranked(output, args, args.output)
+
+def baskets_of(sales):
+    # (datetime, sorted distinct wine ids) per purchase.
+    def mapping_using_time(sale):
+        return (sale.datetime, sale.wine_id)
+
+    return (sales
+        | 'Partition' >> beam.Map(mapping_using_time)
+        | 'GroupingPurchases' >> beam.CombinePerKey(BasketWines()))
+
+
+def purchased_together(sales):
+    # For every wine, the partners bought with it most often and how many
+    # times: "wine\tpartner...\tcount" lines, partners lowest id first.
+    # Wines only ever bought alone get no partner and a count of 0.
+    def number_of_times_wines_have_been_linked(line):
+        # Every wine of a basket is keyed even without partners, so that
+        # it still shows up in the output.
+        g = line[1]
+        for n in g:
+            yield ((n, None), 0)
+            for m in g:
+                if n != m:
+                    yield ((n, m), 1)
+
+    def links_by_wine(line):
+        return (line[0][0], (line[0][1], line[1]))
+
+    def format_output(line):
+        (wine, (n, w)) = line
+        return str(wine) + "\t" + "\t".join(str(m) for m in w) + "\t" + str(n)
+
+    return (baskets_of(sales)
+        | 'TimesLinkedByPurchase' >> beam.FlatMap(number_of_times_wines_have_been_linked)
+        | 'GroupAndSum' >> beam.CombinePerKey(sum)
+        | 'Separate' >> beam.Map(links_by_wine)
+        | 'BestLinks' >> beam.CombinePerKey(BestPartners())
+        | 'Formatting' >> beam.Map(format_output))
 
-        output | WriteToText(args.output)
 
 def step2(args, pipeline_args):
     with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
         lines = p | ReadFromText(args.input)
-        
-        def mapping_using_time(line):   
-            import re
-            t = re.sub('"(.*?)"', '', line) 
-            t = t.split(",")
-            return (str(t[13]), int(t[0]))     
-
-        def number_of_times_wines_have_been_linked(line):
-            g = list(line[1])
-            if len(g) == 1:
-                yield ((str(g[0]), str("-1")), 1)
-            for n in g:
-                for m in g:
-                    if n is not m:
-                        yield ((str(n), str(m)), 1)
-
-        def links_by_wine(line):
-            return (line[0][0], (line[0][1], line[1]))
-
-        def sort_wines_linked(line):
-            wines_sorted = sorted(line[1], key=lambda x: x[1], reverse=True)
-            return (line[0], wines_sorted)
-
-        def only_keep_best_wines(line):
-            w = []
-            n = line[1][0][1]
-
-            if line[1][0][0] == "-1":
-                if len(line[1]) == 1:
-                    return (line[0], [], 0)
-                else:
-                    n = line[1][1][1]
-            for l in line[1]:
-                if l[0] == "-1":
-                    continue
-                elif l[1] == n:
-                    w.append(l[0])
-                else:
-                    break
-            return (line[0], w, n)
-
-        def format_output(line):
-            return line[0] + "\t" + "\t".join(list(line[1])) + "\t" + str(line[2])
 
-        output = (lines 
-            | 'Partition' >> beam.Map(mapping_using_time)
-            | 'GroupingPurchases' >> beam.GroupByKey())
-
-        linked = (output
-            | 'TimesLinkedByPurchase' >> beam.FlatMap(number_of_times_wines_have_been_linked)
-            | 'GroupAndSum' >> beam.CombinePerKey(sum)     
-            | 'Separate' >> beam.Map(links_by_wine)
-            | 'GroupingWines' >> beam.GroupByKey()
-            | 'Sorting' >> beam.Map(sort_wines_linked)
-            | 'BestLinks' >> beam.Map(only_keep_best_wines)
-            | 'Formatting' >> beam.Map(format_output))
+        linked = purchased_together(lines | 'Parse' >> beam.ParDo(ParseSales()))
 
         linked | WriteToText(args.output, file_name_suffix='.csv', num_shards=1)
 
 
+def itemset_candidates(basket, size, singles, subsets):
+    # The size-wine itemsets of a basket worth counting: only frequent
+    # wines are combined, and only itemsets whose every (size - 1)-subset
+    # is in subsets.
+    import itertools
+    wines = [w for w in basket if (w,) in singles]
+    for itemset in itertools.combinations(wines, size):
+        if all(sub in subsets for sub in itertools.combinations(itemset, size - 1)):
+            yield (itemset, 1)
+
+
+def mine_rules(sales, min_support, min_confidence):
+    # Apriori over purchases. Wines below min_support (a fraction of all
+    # purchases) are dropped from every basket before pairs are expanded,
+    # and a triple is only counted when its three pairs are frequent.
+    # Returns the rules ({a} -> b and {a, b} -> c) reaching min_confidence
+    # as (antecedent, consequent, support, confidence, lift), best lift
+    # first, MAX_RULES at most.
+    def min_count(baskets, min_support):
+        import math
+        return max(1, int(math.ceil(baskets * min_support)))
+
+    def frequent(itemset_count, threshold):
+        if itemset_count[1] >= threshold:
+            yield itemset_count
+
+    def rules(itemset_count, singles, pairs, baskets, min_confidence):
+        (itemset, n) = itemset_count
+        for consequent in itemset:
+            antecedent = tuple(w for w in itemset if w != consequent)
+            confidence = float(n) / (singles if len(antecedent) == 1 else pairs)[antecedent]
+            if confidence >= min_confidence:
+                lift = confidence * baskets / singles[(consequent,)]
+                yield (antecedent, consequent, float(n) / baskets, confidence, lift)
+
+    baskets = baskets_of(sales) | 'Baskets' >> beam.Values()
+    total = baskets | 'CountBaskets' >> beam.combiners.Count.Globally()
+    threshold = beam.pvalue.AsSingleton(total | 'MinCount' >> beam.Map(min_count, min_support))
+
+    singles = (baskets
+        | 'Singles' >> beam.FlatMap(lambda basket: [((w,), 1) for w in basket])
+        | 'CountSingles' >> beam.CombinePerKey(sum)
+        | 'FrequentSingles' >> beam.FlatMap(frequent, threshold))
+    pairs = (baskets
+        | 'Pairs' >> beam.FlatMap(itemset_candidates, 2, beam.pvalue.AsDict(singles), beam.pvalue.AsDict(singles))
+        | 'CountPairs' >> beam.CombinePerKey(sum)
+        | 'FrequentPairs' >> beam.FlatMap(frequent, threshold))
+    triples = (baskets
+        | 'Triples' >> beam.FlatMap(itemset_candidates, 3, beam.pvalue.AsDict(singles), beam.pvalue.AsDict(pairs))
+        | 'CountTriples' >> beam.CombinePerKey(sum)
+        | 'FrequentTriples' >> beam.FlatMap(frequent, threshold))
+
+    return ((pairs, triples)
+        | 'Itemsets' >> beam.Flatten()
+        | 'Rules' >> beam.FlatMap(rules, beam.pvalue.AsDict(singles), beam.pvalue.AsDict(pairs),
+                                  beam.pvalue.AsSingleton(total), min_confidence)
+        | 'Ranking' >> beam.combiners.Top.Of(MAX_RULES, key=lambda rule: (rule[4], rule[3]))
+        | 'Unpack' >> beam.FlatMap(lambda top: top))
+
+
+def association_rules(args, pipeline_args):
+    # mine_rules over the input, written as
+    # "antecedent\tconsequent\tsupport\tconfidence\tlift".
+    with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
+        lines = p | ReadFromText(args.input)
+
+        def format_rule(rule):
+            (antecedent, consequent, support, confidence, lift) = rule
+            return '%s\t%s\t%.6f\t%.4f\t%.4f' % (','.join(str(w) for w in antecedent), consequent, support, confidence, lift)
+
+        ranked = (mine_rules(lines | 'Parse' >> beam.ParDo(ParseSales()), args.min_support, args.min_confidence)
+            | 'Formatting' >> beam.Map(format_rule))
+
+        ranked | WriteToText(args.output, file_name_suffix='.tsv', num_shards=1)
+
+
+def all_metrics(args, pipeline_args):
+    # Parses the input once and branches it into the bottles/dollars per
+    # wine/winery aggregations (restricted to --variety when given), each
+    # written to its own '<output>-<metric>' files.
+    with beam.Pipeline(options=PipelineOptions(pipeline_args)) as p:
+
+        lines = p | ReadFromText(args.input)
+
+        def filter_using_variety(sale, variety):
+            if variety is None or sale.variety == variety:
+                yield (sale.wine_id, sale.winery, sale.quantity, sale.quantity*sale.price)
+
+        sales = (lines
+            | 'Parse' >> beam.ParDo(ParseSales())
+            | 'Filter' >> beam.FlatMap(filter_using_variety, args.variety))
+
+        metrics = [
+            ('bottles_sold', lambda sale: (sale[0], sale[2])),
+            ('dollars_sold', lambda sale: (sale[0], sale[3])),
+            ('winery_bottles_sold', lambda sale: (sale[1], sale[2])),
+            ('winery_dollars_sold', lambda sale: (sale[1], sale[3])),
+        ]
+        for name, key_value in metrics:
+            totals = (sales
+                | 'Key_' + name >> beam.Map(key_value)
+                | 'GroupAndSum_' + name >> beam.CombinePerKey(sum))
+            write_ranked(totals, args, args.output + '-' + name, '_' + name)
+
+
+
 def run(args, pipeline_args):
-    if args.purchased_together:
+    if args.all_metrics:
+        all_metrics(args, pipeline_args)
+    elif args.purchased_together:
         step2(args, pipeline_args)
+    elif args.association_rules:
+        association_rules(args, pipeline_args)
     else:
         if args.variety is not None:
             if args.bottles_sold:
@@ -324,6 +519,12 @@ if __name__ == '__main__':
     pipelines.add_argument('--winery_bottles_sold', help="Count the total number of bottles sold for each winery that has had at least one bottle purchased and order the final result from largest to smallest count.", action='store_true')
     pipelines.add_argument('--winery_dollars_sold', help="Calculate the total dollar amount of sales for each winery and order the final result from largest to smallest amount.", action='store_true')
     pipelines.add_argument('--purchased_together', help="For each wine that was purchased at least once, find the other wine that was purchased most often at the same time and count how many times the two wines were purchased together.", action='store_true')
+    pipelines.add_argument('--all_metrics', help="Compute bottles_sold, dollars_sold, winery_bottles_sold and winery_dollars_sold in a single pass over the input, writing each to <output>-<metric>.", action='store_true')
+    pipelines.add_argument('--association_rules', help="Mine association rules between wines bought together (support, confidence, lift), pruning wines and pairs below --min_support.", action='store_true')
+    parser.add_argument('--min_support', help="Minimum fraction of purchases an itemset must appear in (--association_rules).", type=float, default=0.001)
+    parser.add_argument('--min_confidence', help="Minimum confidence of the rules written (--association_rules).", type=float, default=0.1)
+    parser.add_argument('--top', help="Only write the N largest totals, largest first, to a single file.", type=int, default=0)
+    parser.add_argument('--sorted', help="Write every total to a single file, largest first.", action='store_true')
     parser.add_argument('--variety', help="Use the variety whose first letter is the closest to the first letter of your last name. NOTE: THE CHOICE \"Red Blend\" IS GIVEN FOR COMPARISON AGAINST THE GIVEN SOLUTION. DO NOT USE \"Red Blend\" FOR YOUR ASSIGNMENT SUBMISSION. To use \"Red Blend\" as a script argument place it in double quotes.", choices=["Chardonnay", "Malbec", "Pinot Noir", "Red Blend", "Riesling", "Sauvignon Blanc", "Zinfandel"])
     args = parser.parse_args()
 
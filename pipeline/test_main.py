@@ -0,0 +1,103 @@
+#!/usr/bin/env python2.7
+# The purchased_together and association_rules pipelines on a small,
+# hand-computed set of purchases.
+#
+#   python -m unittest test_main
+import unittest
+
+import apache_beam as beam
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that
+from apache_beam.testing.util import equal_to
+
+from main import ParseSales
+from main import itemset_candidates
+from main import mine_rules
+from main import purchased_together
+
+# The purchases, by time. Wine 1 is bought twice in the 11:05 purchase,
+# which still counts once; wine 4 is only ever bought alone.
+PURCHASES = [
+    ('2017-11-01 10:00:00', [1, 2, 3]),
+    ('2017-11-01 11:00:00', [1, 2]),
+    ('2017-11-01 11:05:00', [1, 1, 2]),
+    ('2017-11-01 12:00:00', [2, 3]),
+    ('2017-11-01 13:00:00', [4]),
+    ('2017-11-01 14:00:00', [3, 5, 6]),
+    ('2017-11-01 15:00:00', [1, 2, 3]),
+]
+
+
+def sale_line(wine_id, datetime):
+    return ','.join([str(wine_id), 'France', '"Ripe, juicy"', 'Reserve', '90',
+                     '20', 'Bordeaux', 'Pauillac', '', 'Malbec',
+                     'Chateau %d' % wine_id, '1', 'user', datetime])
+
+
+def sales(p):
+    lines = ['Index,Country,Description,Designation,Points,Price,Province,'
+             'Region_1,Region_2,Variety,Winery,Quantity,User,DateTime',
+             'not,a,sale']
+    for datetime, wines in PURCHASES:
+        lines.extend(sale_line(wine_id, datetime) for wine_id in wines)
+    return (p
+        | beam.Create(lines)
+        | 'Parse' >> beam.ParDo(ParseSales()))
+
+
+class PurchasedTogetherTest(unittest.TestCase):
+
+    def test_best_partners(self):
+        # Times bought together: 1-2 4, 1-3 2, 2-3 3, and 3-5, 3-6, 5-6
+        # once each. Tied partners are listed lowest id first.
+        with TestPipeline() as p:
+            assert_that(purchased_together(sales(p)), equal_to([
+                '1\t2\t4',
+                '2\t1\t4',
+                '3\t2\t3',
+                '4\t\t0',
+                '5\t3\t6\t1',
+                '6\t3\t5\t1',
+            ]))
+
+
+class AssociationRulesTest(unittest.TestCase):
+
+    def test_candidates_skip_infrequent_wines_and_subsets(self):
+        singles = {(1,): 4, (2,): 5, (3,): 4}
+        self.assertEqual(
+            sorted(itemset_candidates([1, 2, 3, 5], 2, singles, singles)),
+            [((1, 2), 1), ((1, 3), 1), ((2, 3), 1)])
+        pairs = {(1, 2): 4, (2, 3): 3}
+        self.assertEqual(
+            list(itemset_candidates([1, 2, 3], 3, singles, pairs)), [])
+        pairs[(1, 3)] = 2
+        self.assertEqual(
+            list(itemset_candidates([1, 2, 3], 3, singles, pairs)),
+            [((1, 2, 3), 1)])
+
+    def test_rules(self):
+        # 7 purchases and a support of 0.25: itemsets need 2 of them, which
+        # leaves wines 1 (4), 2 (5) and 3 (4), pairs 1-2 (4), 1-3 (2) and
+        # 2-3 (3), and the triple 1-2-3 (2). Confidence is the itemset's
+        # count over its antecedent's, lift the confidence over the
+        # consequent's share of purchases.
+        def rounded(rule):
+            (antecedent, consequent, support, confidence, lift) = rule
+            return (antecedent, consequent, round(support, 4),
+                    round(confidence, 4), round(lift, 4))
+
+        with TestPipeline() as p:
+            rules = mine_rules(sales(p), 0.25, 0.55) | beam.Map(rounded)
+            assert_that(rules, equal_to([
+                ((2,), 1, 0.5714, 0.8, 1.4),
+                ((1,), 2, 0.5714, 1.0, 1.4),
+                ((3,), 2, 0.4286, 0.75, 1.05),
+                ((2,), 3, 0.4286, 0.6, 1.05),
+                ((2, 3), 1, 0.2857, 0.6667, 1.1667),
+                ((1, 3), 2, 0.2857, 1.0, 1.4),
+            ]))
+
+
+if __name__ == '__main__':
+    unittest.main()